@@ -13,11 +13,204 @@ parser.add_argument(
     help='Run the HTTP server.'
 )
 
+parser.add_argument(
+    '--scheduler',
+    dest='scheduler',
+    action='store_true',
+    help='Run the poll scheduler.'
+)
+
+parser.add_argument(
+    '--worker',
+    dest='worker',
+    choices=['location', 'tokens', 'corporation', 'skills', 'maintenance'],
+    help='Run a Celery worker for a single queue.'
+)
+
+parser.add_argument(
+    '--scheduler-stats',
+    dest='scheduler_stats',
+    action='store_true',
+    help='Show poll intervals and results per kind.'
+)
+
+parser.add_argument(
+    '--polls',
+    dest='polls',
+    action='store_true',
+    help='List orphaned polls and leftover poll chains.'
+)
+
+parser.add_argument(
+    '--reap-polls',
+    dest='reap_polls',
+    action='store_true',
+    help='Remove orphaned polls, stale leases and duplicate poll chains.'
+)
+
+parser.add_argument(
+    '--esi-usage',
+    dest='esi_usage',
+    action='store_true',
+    help='Show the ESI rate limiter state.'
+)
+
+parser.add_argument(
+    '--esi-cache',
+    dest='esi_cache',
+    action='store_true',
+    help='Show the ESI response cache hit rates per endpoint.'
+)
+
+parser.add_argument(
+    '--history-stats',
+    dest='history_stats',
+    action='store_true',
+    help='Show how the history buffer is being written.'
+)
+
+parser.add_argument(
+    '--compact-history',
+    dest='compact_history',
+    action='store_true',
+    help='Roll up and remove old location and ship history.'
+)
+
+parser.add_argument(
+    '--sync-skill-groups',
+    dest='sync_skill_groups',
+    action='store_true',
+    help='Load skill groups from ESI and recount skillpoints per group.'
+)
+
+parser.add_argument(
+    '--rebuild-state',
+    dest='rebuild_state',
+    action='store_true',
+    help='Rebuild the last known and current state of every character from its history.'
+)
+
+parser.add_argument(
+    '--benchmark',
+    dest='benchmark',
+    choices=['poller', 'skills', 'http', 'pages'],
+    help='Run a benchmark against local stand-ins.'
+)
+
+parser.add_argument(
+    '--characters',
+    dest='characters',
+    type=int,
+    default=1000,
+    help='Amount of characters to benchmark with.'
+)
+
+parser.add_argument(
+    '--concurrency',
+    dest='concurrency',
+    type=int,
+    default=None,
+    help='Concurrency to benchmark with, defaults to the configured value.'
+)
+
 def main():
     arguments = parser.parse_args()
 
     if arguments.http_server:
         http_main()
 
+    if arguments.scheduler:
+        from apoptosis.queue import user as queue_user
+        from apoptosis.queue import scheduler
+
+        queue_user.setup()
+        scheduler.run()
+
+    if arguments.worker:
+        from apoptosis.queue.celery import worker
+
+        worker(arguments.worker)
+
+    if arguments.scheduler_stats:
+        from apoptosis.queue import user as queue_user
+        from apoptosis.queue import scheduler
+
+        for kind, stats in scheduler.stats().items():
+            print("{kind:<12} floor {floor:>6}s  backed off {backed_off:>6}  mean {mean_interval:>8.1f}s  "
+                  "max {max_interval:>8.1f}s  changed {changed:>8}  unchanged {unchanged:>8}".format(kind=kind, **stats))
+
+    if arguments.polls or arguments.reap_polls:
+        from apoptosis.queue import user as queue_user
+        from apoptosis.queue import scheduler
+
+        found = scheduler.audit()
+
+        print("{} polls scheduled, {} leased".format(found["scheduled"], found["leased"]))
+
+        for member in found["orphaned"]:
+            print("orphaned poll {}".format(member))
+
+        for lease in found["stale_leases"]:
+            print("stale lease {}".format(lease))
+
+        for chain in found["chains"]:
+            print("chain {} {}{}".format(chain["id"], chain["name"], tuple(chain["args"])))
+
+        print("{} duplicate chains".format(len(found["duplicate_chains"])))
+
+        if arguments.reap_polls:
+            scheduler.reap(found)
+
+    if arguments.esi_usage:
+        from apoptosis.eve import ratelimit
+
+        for key, value in sorted(ratelimit.usage().items()):
+            print("{:<22} {}".format(key, value))
+
+    if arguments.esi_cache:
+        from apoptosis.eve import esi
+
+        for endpoint, counts in sorted(esi.cache_stats().items()):
+            total = sum(counts.values())
+
+            print("{:<32} {:>8} hit {:>8} not modified {:>8} miss {:>6.1%} served from cache".format(
+                endpoint, counts["hit"], counts["not_modified"], counts["miss"],
+                (counts["hit"] + counts["not_modified"]) / total if total else 0))
+
+    if arguments.history_stats:
+        from apoptosis.queue import history
+
+        from apoptosis.queue import retention
+
+        for key, value in sorted(history.stats().items()):
+            print("{:<22} {}".format(key, value))
+
+        print("last retention run     {}".format(retention.last_run()))
+
+    if arguments.compact_history:
+        from apoptosis.queue import retention
+
+        for table, results in sorted(retention.compact().items()):
+            print("{:<28} {rows_removed} rows from {characters} characters in {seconds}s, {bytes_reclaimed} bytes reclaimed".format(table, **results))
+
+    if arguments.sync_skill_groups:
+        from apoptosis.queue import skills
+
+        print("synced {} skills".format(skills.sync()))
+
+    if arguments.rebuild_state:
+        from apoptosis.queue import state
+
+        print("rebuilt the state of {} characters".format(state.rebuild()))
+
+    if arguments.benchmark:
+        from apoptosis.commands import benchmark
+
+        benchmark.run(
+            arguments.benchmark,
+            characters=arguments.characters,
+            concurrency=arguments.concurrency
+        )
+
 if __name__ == '__main__':
     main()
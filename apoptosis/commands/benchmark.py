@@ -0,0 +1,341 @@
+import os
+import json
+import time
+import tempfile
+
+from datetime import datetime
+
+import tornado.gen
+import tornado.web
+import tornado.ioloop
+import tornado.netutil
+import tornado.httpserver
+import tornado.httpclient
+import tornado.locale
+
+from tornado.web import create_signed_value
+
+from sqlalchemy import create_engine, event
+
+from apoptosis import config
+
+import apoptosis
+
+from apoptosis.models import session, Base, CharacterModel, UserModel, UserLoginModel, GroupModel, MembershipModel
+from apoptosis.queue.character import update_skills
+from apoptosis.queue.poller import Poller
+from apoptosis.eve.sso import store_access_token
+
+
+# Canned responses for the ESI stand-in, shaped like the real thing
+esi_responses = {
+    "online": {"online": True},
+    "location": {"solar_system_id": 30000142},
+    "ship": {"ship_item_id": 1000000000001, "ship_type_id": 587, "ship_name": "Benchmark"},
+    "skills": {"skills": [
+        {"skill_id": 3300 + i, "current_skill_level": 5, "skillpoints_in_skill": 256000}
+        for i in range(300)
+    ]},
+    "corporation": {"name": "Benchmark", "corporation_id": 98000001}
+}
+
+
+class ESIStandInHandler(tornado.web.RequestHandler):
+    def initialize(self, kind, latency):
+        self.kind = kind
+        self.latency = latency
+
+    async def get(self, character_id):
+        await tornado.gen.sleep(self.latency)
+        self.write(json.dumps(esi_responses[self.kind]))
+
+
+def esi_stand_in(latency):
+    """Start a local ESI stand-in answering every character endpoint after
+       `latency` seconds. Returns the base URL to point `esi_url` at."""
+    app = tornado.web.Application([
+        (r"/characters/(\d+)/online/", ESIStandInHandler, {"kind": "online", "latency": latency}),
+        (r"/characters/(\d+)/location/", ESIStandInHandler, {"kind": "location", "latency": latency}),
+        (r"/characters/(\d+)/ship/", ESIStandInHandler, {"kind": "ship", "latency": latency}),
+        (r"/characters/(\d+)/skills/", ESIStandInHandler, {"kind": "skills", "latency": latency}),
+        (r"/characters/(\d+)/", ESIStandInHandler, {"kind": "corporation", "latency": latency}),
+    ])
+
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+
+    return "http://127.0.0.1:{}".format(sockets[0].getsockname()[1])
+
+
+async def poller(characters=1000, concurrency=None, latency=0.05, **kwargs):
+    """Measure how many characters per second the poller gets through when
+       polling every kind for each."""
+    config.esi_url = esi_stand_in(latency)
+
+    # The stand-in has no rate limit to respect, only the limiter overhead counts
+    config.esi_rate_limit = config.esi_rate_burst = 1000000
+
+    kinds = list(esi_responses)
+    characters = [
+        CharacterModel(character_id=90000000 + i, character_name="Benchmark {}".format(i))
+        for i in range(characters)
+    ]
+
+    for character in characters:
+        store_access_token(character.character_id, "benchmark", 1200)
+
+    # Only the polling is measured here, results are thrown away
+    engine = Poller(concurrency=concurrency, on_result=lambda character, kind, data: None, prepare=None)
+
+    started = time.time()
+    await engine.poll(characters, kinds)
+    elapsed = time.time() - started
+
+    engine.close()
+
+    print("polled {} characters ({} requests, {} failed) in {:.2f}s with concurrency {}".format(
+        len(characters), engine.polled + engine.failed, engine.failed, elapsed, engine.concurrency))
+    print("{:.1f} characters/s".format(len(characters) / elapsed))
+
+
+def benchmark_database(threads=False):
+    """Point the session at a fresh in-memory database and return a list that
+       every executed statement gets appended to. With `threads` the database
+       is a temporary file so it can be shared by the database threads."""
+    if threads:
+        handle, path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+
+        engine = create_engine("sqlite:///{}".format(path), connect_args={"check_same_thread": False})
+    else:
+        engine = create_engine("sqlite://")
+
+    Base.metadata.create_all(engine)
+
+    session.remove()
+    session.configure(bind=engine)
+
+    statements = []
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    return statements
+
+
+async def skills(characters=100, **kwargs):
+    """Measure the queries and time a skill refresh takes, for the first sync,
+       a sync where some skills trained and one where nothing changed."""
+    statements = benchmark_database()
+
+    characters = [
+        CharacterModel(character_id=90000000 + i, character_name="Benchmark {}".format(i))
+        for i in range(characters)
+    ]
+
+    session.add_all(characters)
+    session.commit()
+
+    trained = {"skills": [dict(skill) for skill in esi_responses["skills"]["skills"]]}
+
+    for skill in trained["skills"][:5]:
+        skill["skillpoints_in_skill"] += 1000
+
+    for name, result in [("initial", esi_responses["skills"]), ("trained", trained), ("unchanged", trained)]:
+        del statements[:]
+        started = time.time()
+
+        for character in characters:
+            update_skills(character, result)
+            session.commit()
+
+        elapsed = time.time() - started
+
+        print("{:<10} {:>6.1f} queries/refresh {:>8.1f} refreshes/s".format(
+            name, len(statements) / len(characters), len(characters) / elapsed))
+
+
+def _percentile(latencies, percentile):
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * percentile))]
+
+
+async def _load(url, cookie, requests=None, concurrency=1, until=None):
+    """Request `url`, `concurrency` at a time, until it was requested
+       `requests` times or `until` is done. Returns the latency of each request."""
+    client = tornado.httpclient.AsyncHTTPClient()
+    latencies = []
+
+    async def worker():
+        while (until is None or not until.done()) and (requests is None or len(latencies) < requests):
+            started = time.time()
+            await client.fetch(url, headers={"Cookie": "user_id={}".format(cookie)})
+            latencies.append(time.time() - started)
+
+    await tornado.gen.multi([worker() for _ in range(concurrency)])
+
+    return latencies
+
+
+def _site(users=100, characters=1000):
+    """Fill the benchmark database with an admin and `users` users sharing
+       `characters` characters, each with a login and a group membership.
+       Returns the cookie to request pages as the admin with."""
+    config.internal_alliance_ids = [99000001]
+
+    admin = UserModel(is_admin=True, last_login_date=datetime.now())
+    admin.characters.append(CharacterModel(
+        character_id=90000000, character_name="Benchmark", is_main=True, alliance_id=99000001))
+
+    groups = [
+        GroupModel(name="Benchmark {}".format(i), slug="benchmark-{}".format(i), requires_approval=True)
+        for i in range(5)
+    ]
+
+    members = [UserModel(last_login_date=datetime.now()) for i in range(users)]
+
+    for i in range(characters):
+        members[i % users].characters.append(CharacterModel(
+            character_id=90000001 + i, character_name="Benchmark {}".format(i),
+            is_main=i < users, alliance_id=99000001, skillpoints=i * 1000))
+
+    for i, user in enumerate(members):
+        session.add(UserLoginModel(user=user, pub_date=datetime.now(), ip_address="10.0.0.{}".format(i % 10)))
+        session.add(MembershipModel(group=groups[i % len(groups)], user=user, pending=i % 3 == 0))
+
+    session.add(admin)
+    session.add_all(members)
+    session.commit()
+
+    cookie = create_signed_value(config.tornado_secret, "user_id", str(admin.id)).decode("utf-8")
+    session.remove()
+
+    return cookie
+
+
+def _serve():
+    """Serve the application with the bundled templates, returns the server
+       and its base URL."""
+    from apoptosis.http.server import make_app
+
+    root = os.path.dirname(apoptosis.__file__)
+
+    config.tornado_templates = os.path.join(root, "templates")
+    config.tornado_static = os.path.join(root, "static")
+
+    tornado.locale.load_translations(os.path.join(root, "translations"))
+
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+
+    server = tornado.httpserver.HTTPServer(make_app())
+    server.add_sockets(sockets)
+
+    return server, "http://127.0.0.1:{}".format(sockets[0].getsockname()[1])
+
+
+async def http(characters=1000, concurrency=None, latency=0.2, requests=200, **kwargs):
+    """Measure the latency of a light page while admin pages with a slow query
+       are being rendered, with database work on the IOLoop and on the
+       database threads."""
+    benchmark_database(threads=True)
+
+    # Every admin listing waits `latency` seconds on the database
+    @event.listens_for(session.get_bind(), "before_cursor_execute")
+    def slow(conn, cursor, statement, parameters, context, executemany):
+        if "ORDER BY lower(character.character_name)" in statement:
+            time.sleep(latency)
+
+    config.tornado_secret = "benchmark"
+
+    cookie = _site(max(characters // 10, 1), characters)
+    server, base = _serve()
+
+    concurrency = concurrency or 10
+    workers = config.database_workers
+
+    for name, database_workers in [("ioloop", 0), ("threads", workers)]:
+        config.database_workers = database_workers
+
+        idle = await _load(base + "/", cookie, requests, concurrency)
+
+        # Two admins keep reloading the character listing meanwhile
+        loaded = tornado.gen.convert_yielded(_load(base + "/", cookie, requests, concurrency))
+        await tornado.gen.multi([loaded, _load(base + "/admin/characters", cookie, concurrency=2, until=loaded)])
+        loaded = loaded.result()
+
+        for load, latencies in [("idle", idle), ("admin", loaded)]:
+            print("{:<8} {:<6} p50 {:>8.1f}ms p99 {:>8.1f}ms".format(
+                name, load, _percentile(latencies, 0.5) * 1000, _percentile(latencies, 0.99) * 1000))
+
+    config.database_workers = workers
+    server.stop()
+
+
+async def pages(characters=1000, **kwargs):
+    """Count the statements every page runs on a small site and on one with
+       `characters` characters, against the query ceiling of the page. A page
+       running as many on both has no queries per row left."""
+    from apoptosis.http import pages
+
+    paths = [
+        ("/", pages.HomePage),
+        ("/characters", pages.CharactersPage),
+        ("/services", pages.ServicesPage),
+        ("/groups", pages.GroupsPage),
+        ("/ping", pages.PingPage),
+        ("/admin", pages.AdminPage),
+        ("/admin/groups", pages.AdminGroupsPage),
+        ("/admin/groups/manage?group_id=1", pages.AdminGroupsManagePage),
+        ("/admin/users", pages.AdminUsersPage),
+        ("/admin/users/ip_address?address=10.0.0.1", pages.AdminUsersIPAddressPage),
+        ("/admin/users/detail?user_id=2", pages.AdminUsersDetailPage),
+        ("/admin/characters", pages.AdminCharactersPage),
+        ("/admin/characters/detail?character_id=2", pages.AdminCharactersDetailPage)
+    ]
+
+    config.tornado_secret = "benchmark"
+    client = tornado.httpclient.AsyncHTTPClient()
+    counts = {}
+
+    for size in [characters // 10, characters]:
+        statements = benchmark_database(threads=True)
+        cookie = _site(max(size // 10, 1), size)
+        server, base = _serve()
+
+        for path, page in paths:
+            # The first request fills the static indexes and caches
+            for _ in range(2):
+                del statements[:]
+                await client.fetch(base + path, headers={"Cookie": "user_id={}".format(cookie)})
+
+            counts.setdefault(path, []).append(len(statements))
+
+        server.stop()
+
+    over = 0
+
+    for path, page in paths:
+        small, large = counts[path]
+        ceiling = page.query_ceiling
+        failed = ceiling is not None and max(small, large) > ceiling
+        over += failed
+
+        print("{:<45} {:>4} {:>4}  ceiling {:>4} {}".format(path, small, large, str(ceiling), "OVER" if failed else ""))
+
+    if over:
+        raise SystemExit("{} pages went over their query ceiling".format(over))
+
+
+benchmarks = {
+    "poller": poller,
+    "skills": skills,
+    "http": http,
+    "pages": pages
+}
+
+
+def run(name, **kwargs):
+    tornado.ioloop.IOLoop.current().run_sync(lambda: benchmarks[name](**kwargs))
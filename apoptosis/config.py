@@ -7,9 +7,54 @@ define("redis_database", default=0, help="Redis server database")
 define("redis_password", default="", help="Redis server password")
 
 define("database_uri", default="sqlite:////tmp/apoptosis.db", help="Database URI")
+define("database_replica_uri", default="", help="Database URI of a read replica for read only pages, empty to read from the primary")
+define("database_pool_size", default=10, help="Connections kept open per process")
+define("database_max_overflow", default=20, help="Connections opened on top of the pool under load")
+define("database_pool_recycle", default=3600, help="Seconds after which a connection is replaced")
+define("database_pool_pre_ping", default=True, help="Test connections before handing them out")
+define("database_workers", default=8, help="Threads running database work for pages, 0 to run it on the IOLoop")
+define("database_heavy_workers", default=2, help="Threads running database work for heavy pages such as the admin listings")
 
 define("http_port", default=5000, help="HTTP Port")
 
+define("celery_broker", default="redis://localhost", help="Celery broker URL")
+define("celery_backend", default="redis://localhost", help="Celery result backend URL")
+
+define("queue_location_prefetch", default=1, help="Tasks a location worker process reserves at a time")
+define("queue_location_concurrency", default=8, help="Processes per location worker")
+define("queue_tokens_prefetch", default=4, help="Tasks a token worker process reserves at a time")
+define("queue_tokens_concurrency", default=2, help="Processes per token worker")
+define("queue_corporation_prefetch", default=4, help="Tasks a corporation worker process reserves at a time")
+define("queue_corporation_concurrency", default=2, help="Processes per corporation worker")
+define("queue_skills_prefetch", default=4, help="Tasks a skills worker process reserves at a time")
+define("queue_skills_concurrency", default=2, help="Processes per skills worker")
+define("queue_maintenance_prefetch", default=1, help="Tasks a maintenance worker process reserves at a time")
+define("queue_maintenance_concurrency", default=1, help="Processes per maintenance worker")
+
+define("scheduler_interval", default=1.0, help="Seconds between scheduler ticks")
+define("scheduler_batch_size", default=100, help="Characters per dispatched poll batch")
+define("poll_lease_timeout", default=600, help="Seconds before the lease of an unfinished poll expires")
+define("poll_backoff_step", default=1.5, help="Factor a poll interval grows by while results are unchanged")
+define("poll_backoff_floor", default=0, help="Shortest interval in seconds a poll backs off from, 0 for the interval of the poll itself")
+define("poll_backoff_ceiling", default=300, help="Longest interval in seconds a poll backs off to")
+
+define("esi_url", default="https://esi.tech.ccp.is/latest", help="EVE ESI base URL")
+define("poller_concurrency", default=50, help="Maximum concurrent ESI requests per poller")
+define("esi_rate_limit", default=50, help="ESI requests per second across all processes")
+define("esi_rate_burst", default=100, help="ESI requests allowed in a burst across all processes")
+define("esi_error_limit_slowdown", default=50, help="Remaining ESI error budget below which requests slow down")
+define("esi_error_limit_floor", default=10, help="Remaining ESI error budget at which requests stop until it resets")
+define("history_buffer_size", default=500, help="Buffered history rows that trigger a write")
+define("history_buffer_interval", default=5.0, help="Seconds buffered history rows wait at most before they are written")
+define("history_buffer_retries", default=3, help="Times a failed history write is tried before its rows are dropped")
+define("history_retention_days", default=30, help="Days location and ship history is kept before it is rolled up")
+define("history_retention_batch_size", default=1000, help="History rows rolled up and removed per transaction")
+define("history_retention_hour", default=4, help="Hour of the day the scheduled history retention runs")
+define("esi_cache_ttl", default=86400, help="Seconds an ESI response is kept for conditional requests")
+define("admin_glance_ttl", default=300, help="Seconds the admin dashboard counts are cached at most")
+define("admin_page_size", default=100, help="Rows per page of the admin listings")
+define("principal_ttl", default=3600, help="Seconds the principal of a user is cached at most")
+
 define("tornado_secret", help="Tornado Secret")
 define("tornado_translations", help="Tornado translations path")
 define("tornado_templates", help="Tornado templates path")
@@ -18,20 +63,73 @@ define("tornado_static", help="Tornado static path")
 define("evesso_clientid", help="EVE SSO client ID")
 define("evesso_secretkey", help="EVE SSO secret key")
 define("evesso_callback", help="EVE SSO callback URI")
+define("evesso_refresh_margin", default=60, help="Seconds before expiry an access token is refreshed")
+define("evesso_refresh_timeout", default=10, help="Seconds to wait on another worker refreshing a token")
+
+define("internal_corporation_ids", default=[], type=int, multiple=True, help="EVE ids of corporations whose members are internal")
+define("internal_alliance_ids", default=[], type=int, multiple=True, help="EVE ids of alliances whose members are internal")
 
 options.define("slack_apitoken", help="Slack API Token")
 
 parse_config_file("/etc/apoptosis.conf")
 
+internal_corporation_ids = options.internal_corporation_ids
+internal_alliance_ids = options.internal_alliance_ids
+
 redis_host = options.redis_host
 redis_port = options.redis_port
 redis_database = options.redis_database
 redis_password = options.redis_password
 
 database_uri = options.database_uri
+database_replica_uri = options.database_replica_uri
+database_pool_size = options.database_pool_size
+database_max_overflow = options.database_max_overflow
+database_pool_recycle = options.database_pool_recycle
+database_pool_pre_ping = options.database_pool_pre_ping
+database_workers = options.database_workers
+database_heavy_workers = options.database_heavy_workers
 
 http_port = options.http_port
 
+celery_broker = options.celery_broker
+celery_backend = options.celery_backend
+
+queue_location_prefetch = options.queue_location_prefetch
+queue_location_concurrency = options.queue_location_concurrency
+queue_tokens_prefetch = options.queue_tokens_prefetch
+queue_tokens_concurrency = options.queue_tokens_concurrency
+queue_corporation_prefetch = options.queue_corporation_prefetch
+queue_corporation_concurrency = options.queue_corporation_concurrency
+queue_skills_prefetch = options.queue_skills_prefetch
+queue_skills_concurrency = options.queue_skills_concurrency
+queue_maintenance_prefetch = options.queue_maintenance_prefetch
+queue_maintenance_concurrency = options.queue_maintenance_concurrency
+
+scheduler_interval = options.scheduler_interval
+scheduler_batch_size = options.scheduler_batch_size
+poll_lease_timeout = options.poll_lease_timeout
+poll_backoff_step = options.poll_backoff_step
+poll_backoff_floor = options.poll_backoff_floor
+poll_backoff_ceiling = options.poll_backoff_ceiling
+
+esi_url = options.esi_url
+poller_concurrency = options.poller_concurrency
+esi_rate_limit = options.esi_rate_limit
+esi_rate_burst = options.esi_rate_burst
+esi_error_limit_slowdown = options.esi_error_limit_slowdown
+esi_error_limit_floor = options.esi_error_limit_floor
+esi_cache_ttl = options.esi_cache_ttl
+admin_glance_ttl = options.admin_glance_ttl
+admin_page_size = options.admin_page_size
+principal_ttl = options.principal_ttl
+history_retention_days = options.history_retention_days
+history_retention_batch_size = options.history_retention_batch_size
+history_retention_hour = options.history_retention_hour
+history_buffer_size = options.history_buffer_size
+history_buffer_interval = options.history_buffer_interval
+history_buffer_retries = options.history_buffer_retries
+
 tornado_secret = options.tornado_secret
 tornado_translations = options.tornado_translations
 tornado_templates = options.tornado_templates
@@ -40,5 +138,7 @@ tornado_static = options.tornado_static
 evesso_clientid = options.evesso_clientid
 evesso_secretkey = options.evesso_secretkey
 evesso_callback = options.evesso_callback
+evesso_refresh_margin = options.evesso_refresh_margin
+evesso_refresh_timeout = options.evesso_refresh_timeout
 
 slack_apitoken = options.slack_apitoken
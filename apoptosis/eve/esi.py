@@ -1,4 +1,310 @@
+import re
+import json
+import time
+import threading
+
+import email.utils
+
+import tornado.httpclient
+
+from apoptosis import config
+from apoptosis.cache import redis_cache
+from apoptosis.eve import ratelimit
+
+from anoikis.api.exceptions import InvalidToken
+
+
 default_scopes = {
-    "esi-location.read_location.v1", "esi-location.read_ship_type.v1",
+    "esi-location.read_location.v1", "esi-location.read_ship_type.v1", "esi-location.read_online.v1",
     "esi-skills.read_skills.v1", "esi-skills.read_skillqueue.v1"
 }
+
+# Character endpoints the pollers use, per poll kind the path and whether it
+# needs the characters access token.
+character_endpoints = {
+    "online": ("/characters/{}/online/", True),
+    "location": ("/characters/{}/location/", True),
+    "ship": ("/characters/{}/ship/", True),
+    "skills": ("/characters/{}/skills/", True),
+    "corporation": ("/characters/{}/", False)
+}
+
+
+# Responses are cached per path until ESI says they expire, after that the
+# ETag is used to ask ESI whether anything changed.
+cache_key = "apoptosis:esi:cache:{}"
+cache_stats_key = "apoptosis:esi:cache:stats"
+
+# Entries for responses requested with `changes_only` are held back per thread
+# until the caller committed what changed, see `store_pending`. Until then a
+# poll that failed to write gets the whole response again, not `unchanged`.
+pending = threading.local()
+
+
+class Unchanged(object):
+    def __repr__(self):
+        return "<unchanged>"
+
+# Returned instead of a body with `changes_only` when the response is the same
+# as the last time the path was requested.
+unchanged = Unchanged()
+
+
+def _endpoint(path):
+    return re.sub(r"\d+", "{}", path)
+
+
+def _count(path, outcome):
+    redis_cache.hincrby(cache_stats_key, "{} {}".format(_endpoint(path), outcome))
+
+
+def _cached(path):
+    cached = redis_cache.hgetall(cache_key.format(path))
+
+    if not cached:
+        return None
+
+    return {
+        "body": cached[b"body"],
+        "etag": cached.get(b"etag", b"").decode("utf-8"),
+        "expires": float(cached[b"expires"])
+    }
+
+
+def _pending():
+    if not hasattr(pending, "entries"):
+        pending.entries = {}
+
+    return pending.entries
+
+
+def _write(entries):
+    pipeline = redis_cache.pipeline()
+
+    for path, entry in entries.items():
+        pipeline.hset(cache_key.format(path), mapping=entry)
+        pipeline.expire(cache_key.format(path), config.esi_cache_ttl)
+
+    pipeline.execute()
+
+
+def _store(path, response, body, defer=False):
+    expires = response.headers.get("Expires")
+    expires = email.utils.parsedate_to_datetime(expires).timestamp() if expires else 0
+
+    entry = {"body": body, "expires": expires}
+
+    if response.headers.get("ETag"):
+        entry["etag"] = response.headers["ETag"]
+
+    if defer:
+        _pending()[path] = entry
+    else:
+        _write({path: entry})
+
+
+def store_pending():
+    """Cache the responses held back in this thread, once what they changed
+       is committed."""
+    entries = _pending()
+
+    if entries:
+        _write(entries)
+        entries.clear()
+
+
+def discard_pending():
+    """Drop the responses held back in this thread, what they changed was not
+       written."""
+    _pending().clear()
+
+
+def forget_character(character_id, kinds=None):
+    """Drop the cached responses of a character, held back or stored, so it
+       is seen in full on its next poll."""
+    paths = [character_endpoints[kind][0].format(character_id) for kind in kinds or character_endpoints]
+
+    for path in paths:
+        _pending().pop(path, None)
+
+    redis_cache.delete(*(cache_key.format(path) for path in paths))
+
+
+def _hit(path, cached, changes_only):
+    if cached is None or cached["expires"] <= time.time():
+        return None
+
+    _count(path, "hit")
+
+    return unchanged if changes_only else json.loads(cached["body"].decode("utf-8"))
+
+
+# /universe/names/ takes at most this many ids per request
+names_batch_size = 1000
+
+
+def _request(path, access_token=None, cached=None, body=None):
+    headers = {
+        "User-Agent": "Hard Knocks Inc. Authentication System"
+    }
+
+    if access_token:
+        headers["Authorization"] = "Bearer {}".format(access_token)
+
+    if cached and cached["etag"]:
+        headers["If-None-Match"] = cached["etag"]
+
+    if body is None:
+        return tornado.httpclient.HTTPRequest(config.esi_url + path, headers=headers)
+
+    headers["Content-Type"] = "application/json"
+
+    return tornado.httpclient.HTTPRequest(config.esi_url + path, method="POST", headers=headers, body=json.dumps(body))
+
+
+def _response(path, response, changes_only):
+    ratelimit.record(response.headers)
+
+    _count(path, "miss")
+    _store(path, response, response.body, defer=changes_only)
+
+    return json.loads(response.body.decode("utf-8"))
+
+
+def _error(path, error, cached, changes_only):
+    if error.response is not None:
+        ratelimit.record(error.response.headers)
+
+    if error.code == 304 and cached is not None:
+        _count(path, "not_modified")
+        _store(path, error.response, cached["body"], defer=changes_only)
+
+        return unchanged if changes_only else json.loads(cached["body"].decode("utf-8"))
+
+    if error.code in (401, 403):
+        raise InvalidToken(error.message)
+
+    raise error
+
+
+def request(path, access_token=None, changes_only=False):
+    """Request an ESI path, blocking until the response is in. With
+       `changes_only` a response that is the same as last time is returned as
+       `unchanged`."""
+    cached = _cached(path)
+    hit = _hit(path, cached, changes_only)
+
+    if hit is not None:
+        return hit
+
+    ratelimit.acquire()
+
+    client = tornado.httpclient.HTTPClient()
+
+    try:
+        return _response(path, client.fetch(_request(path, access_token, cached)), changes_only)
+    except tornado.httpclient.HTTPError as error:
+        return _error(path, error, cached, changes_only)
+    finally:
+        client.close()
+
+
+async def fetch(path, access_token=None, client=None, changes_only=False):
+    """Request an ESI path asynchronously, see `request`."""
+    cached = _cached(path)
+    hit = _hit(path, cached, changes_only)
+
+    if hit is not None:
+        return hit
+
+    await ratelimit.acquire_async()
+
+    client = client or tornado.httpclient.AsyncHTTPClient()
+
+    try:
+        return _response(path, await client.fetch(_request(path, access_token, cached)), changes_only)
+    except tornado.httpclient.HTTPError as error:
+        return _error(path, error, cached, changes_only)
+
+
+def _posted(response):
+    ratelimit.record(response.headers)
+
+    return json.loads(response.body.decode("utf-8"))
+
+
+def post(path, body):
+    """POST to an ESI path, blocking until the response is in. These responses
+       are not cached."""
+    ratelimit.acquire()
+
+    client = tornado.httpclient.HTTPClient()
+
+    try:
+        return _posted(client.fetch(_request(path, body=body)))
+    except tornado.httpclient.HTTPError as error:
+        _error(path, error, None, False)
+    finally:
+        client.close()
+
+
+async def fetch_post(path, body, client=None):
+    """POST to an ESI path asynchronously, see `post`."""
+    await ratelimit.acquire_async()
+
+    client = client or tornado.httpclient.AsyncHTTPClient()
+
+    try:
+        return _posted(await client.fetch(_request(path, body=body)))
+    except tornado.httpclient.HTTPError as error:
+        _error(path, error, None, False)
+
+
+def _batches(eve_ids):
+    eve_ids = list(set(eve_ids))
+
+    return [eve_ids[start:start + names_batch_size] for start in range(0, len(eve_ids), names_batch_size)]
+
+
+def names(eve_ids):
+    """Resolve eve ids of any kind to their names, batching as many ids into
+       one request as ESI allows."""
+    return {
+        entry["id"]: entry["name"]
+        for batch in _batches(eve_ids)
+        for entry in post("/universe/names/", batch)
+    }
+
+
+async def fetch_names(eve_ids, client=None):
+    """Resolve eve ids to their names asynchronously, see `names`."""
+    resolved = {}
+
+    for batch in _batches(eve_ids):
+        for entry in await fetch_post("/universe/names/", batch, client=client):
+            resolved[entry["id"]] = entry["name"]
+
+    return resolved
+
+
+def request_character(kind, character_id, access_token=None, changes_only=False):
+    """Request one of the `character_endpoints` for a character."""
+    path, authenticated = character_endpoints[kind]
+    return request(path.format(character_id), access_token=access_token, changes_only=changes_only)
+
+
+async def fetch_character(kind, character_id, access_token=None, client=None, changes_only=False):
+    """Request one of the `character_endpoints` for a character asynchronously."""
+    path, authenticated = character_endpoints[kind]
+    return await fetch(path.format(character_id), access_token=access_token, client=client, changes_only=changes_only)
+
+
+def cache_stats():
+    """Hits, conditional requests ESI answered with 304 and misses per endpoint."""
+    stats = {}
+
+    for key, value in redis_cache.hgetall(cache_stats_key).items():
+        endpoint, outcome = key.decode("utf-8").rsplit(" ", 1)
+        stats.setdefault(endpoint, {"hit": 0, "not_modified": 0, "miss": 0})[outcome] = int(value)
+
+    return stats
@@ -0,0 +1,140 @@
+import time
+
+import tornado.gen
+
+from apoptosis.cache import redis_cache
+from apoptosis.log import eve_log
+
+from apoptosis import config
+
+
+bucket_key = "apoptosis:esi:bucket"
+errors_key = "apoptosis:esi:errors"
+requests_prefix = "apoptosis:esi:requests:"
+requests_key = requests_prefix + "{}"
+
+# Takes a token from the bucket shared by every process talking to ESI. The
+# refill rate drops with the remaining ESI error budget and stops altogether
+# once it gets too low, until ESI resets its error window. Returns how long
+# to wait before trying again, or 0 when a token was taken. The time is that
+# of Redis so processes on hosts with skewed clocks share the same bucket.
+take_script = redis_cache.register_script("""
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local slowdown = tonumber(ARGV[3])
+local floor = tonumber(ARGV[4])
+
+local time = redis.call("time")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local remain = tonumber(redis.call("hget", KEYS[2], "remain"))
+
+if remain then
+    if remain <= floor then
+        return tostring(math.max(redis.call("pttl", KEYS[2]), 100) / 1000)
+    end
+
+    rate = rate * math.min(1, remain / slowdown)
+end
+
+local tokens = tonumber(redis.call("hget", KEYS[1], "tokens")) or burst
+local updated = tonumber(redis.call("hget", KEYS[1], "updated")) or now
+
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+
+local wait = 0
+
+if tokens >= 1 then
+    tokens = tokens - 1
+
+    local requests = ARGV[5] .. math.floor(now / 60)
+
+    redis.call("incr", requests)
+    redis.call("expire", requests, 120)
+else
+    wait = (1 - tokens) / rate
+end
+
+redis.call("hset", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("expire", KEYS[1], 60)
+
+return tostring(wait)
+""")
+
+
+def _take():
+    return float(take_script(
+        keys=[bucket_key, errors_key],
+        args=[
+            config.esi_rate_limit,
+            config.esi_rate_burst,
+            config.esi_error_limit_slowdown,
+            config.esi_error_limit_floor,
+            requests_prefix
+        ]
+    ))
+
+
+def acquire():
+    """Block until the shared bucket allows another ESI request."""
+    wait = _take()
+
+    while wait > 0:
+        time.sleep(wait)
+        wait = _take()
+
+
+async def acquire_async():
+    """Wait for the shared bucket to allow another ESI request without blocking
+       the IOLoop."""
+    wait = _take()
+
+    while wait > 0:
+        await tornado.gen.sleep(wait)
+        wait = _take()
+
+
+def record(headers):
+    """Remember the error budget ESI reports in a responses headers."""
+    remain = headers.get("X-Esi-Error-Limit-Remain")
+    reset = headers.get("X-Esi-Error-Limit-Reset")
+
+    if remain is None or reset is None:
+        return
+
+    if int(remain) <= config.esi_error_limit_slowdown:
+        eve_log.warn("esi error limit at {}, resets in {}s".format(remain, reset))
+
+    pipeline = redis_cache.pipeline()
+    pipeline.hset(errors_key, "remain", remain)
+    pipeline.expire(errors_key, max(1, int(reset)))
+    pipeline.execute()
+
+
+def usage():
+    """Report the current state of the limiter."""
+    seconds, microseconds = redis_cache.time()
+    now = seconds + microseconds / 1000000
+
+    tokens, updated = redis_cache.hmget(bucket_key, "tokens", "updated")
+    remain = redis_cache.hget(errors_key, "remain")
+
+    rate = config.esi_rate_limit
+
+    if remain is not None:
+        remain = int(remain)
+        rate = 0 if remain <= config.esi_error_limit_floor else rate * min(1, remain / config.esi_error_limit_slowdown)
+
+    if tokens is not None:
+        tokens = min(config.esi_rate_burst, float(tokens) + max(0, now - float(updated)) * rate)
+    else:
+        tokens = config.esi_rate_burst
+
+    return {
+        "rate": rate,
+        "tokens": tokens,
+        "requests_this_minute": int(redis_cache.get(requests_key.format(int(now // 60))) or 0),
+        "requests_last_minute": int(redis_cache.get(requests_key.format(int(now // 60) - 1)) or 0),
+        "error_limit_remain": remain,
+        "error_limit_reset": max(0, redis_cache.ttl(errors_key))
+    }
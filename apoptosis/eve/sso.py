@@ -1,4 +1,6 @@
 import json
+import time
+import uuid
 
 try:
     from urllib.parse import urlencode
@@ -8,15 +10,17 @@ except ImportError:
 import base64
 
 import tornado.httpclient
+import tornado.ioloop
+
+from sqlalchemy.orm.attributes import set_committed_value
 
 from apoptosis import config
 
-from apoptosis.models import session
+from apoptosis.models import session, CharacterModel
+from apoptosis.cache import redis_cache
 from apoptosis.log import app_log
 from apoptosis.eve.esi import default_scopes as esi_scopes
 
-from anoikis.api.exceptions import InvalidToken, ExpiredToken
-
 
 default_scopes = set()
 default_scopes.update(esi_scopes)
@@ -30,19 +34,72 @@ sso_login = "https://login.eveonline.com/oauth/authorize?" + urlencode({
     "state": "foo"  # XXX make JWT
 })
 
+# Access tokens live in redis until shortly before they expire, the lock makes
+# sure only one worker at a time refreshes the token of a character.
+token_key = "apoptosis:token:{}"
+token_lock_key = "apoptosis:token:{}:lock"
 
-def refresh_access_token(character):
-    """Use a characters refresh token to request a new access token."""
-    if character.refresh_token is None:
-        app_log.warn("no refresh token for {}".format(character))
-        return
 
+def store_access_token(character_id, access_token, expires_in):
+    """Cache an access token for a character until `evesso_refresh_margin`
+       seconds before it expires. Tokens are refreshed lazily, the first use
+       after that refreshes it before it actually expires."""
+    expires_in = max(1, int(expires_in) - config.evesso_refresh_margin)
+    redis_cache.setex(token_key.format(character_id), expires_in, access_token)
+
+
+def has_access_token(character_id):
+    """Whether a character has an access token that is not close to expiring."""
+    return bool(redis_cache.exists(token_key.format(character_id)))
+
+
+def _cached_access_token(character, invalid=None):
+    key = token_key.format(character.character_id)
+    access_token = redis_cache.get(key)
+
+    if access_token is None:
+        return None
+
+    access_token = access_token.decode("utf-8")
+
+    if access_token == invalid:
+        redis_cache.delete(key)
+        return None
+
+    return access_token
+
+
+# Releases a lock only if it still holds the token it was taken with, a lock
+# that expired in the meantime may belong to another worker by now.
+unlock_script = redis_cache.register_script("""
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+
+return 0
+""")
+
+
+def _lock(character):
+    """Take the refresh lock of a character, returns its token or None."""
+    token = uuid.uuid4().hex
+
+    if redis_cache.set(token_lock_key.format(character.character_id), token, nx=True, ex=config.evesso_refresh_timeout):
+        return token
+
+
+def _unlock(character, token):
+    unlock_script(keys=[token_lock_key.format(character.character_id)], args=[token])
+
+
+def _refresh_request(character):
     app_log.debug("refreshing access token for {}".format(character.character_name))
 
-    client = tornado.httpclient.HTTPClient()
-    request = tornado.httpclient.HTTPRequest(
+    return tornado.httpclient.HTTPRequest(
         "https://login.eveonline.com/oauth/token",
         method="POST",
+        # The lock expires after this long, so must the refresh
+        request_timeout=config.evesso_refresh_timeout,
         headers={
             "Authorization": "Basic {}".format(sso_auth),
             "Content-Type": "application/json",
@@ -54,14 +111,80 @@ def refresh_access_token(character):
         })
     )
 
-    response = client.fetch(request)
+
+def _store_refresh_token(character, refresh_token):
+    """SSO may rotate the refresh token on a refresh, after which the old one
+       stops working. It is written right away in a transaction of its own so
+       a poll that rolls back doesn't lose it."""
+    writer = session.session_factory()
+
+    try:
+        writer.query(CharacterModel).filter(CharacterModel.id==character.id).update(
+            {"refresh_token": refresh_token}, synchronize_session=False
+        )
+        writer.commit()
+    finally:
+        writer.close()
+
+    set_committed_value(character, "refresh_token", refresh_token)
+
+
+def _refresh_response(character, response):
     response = json.loads(response.body.decode("utf-8"))
 
-    character.access_token = response["access_token"]
+    if response.get("refresh_token") and response["refresh_token"] != character.refresh_token:
+        _store_refresh_token(character, response["refresh_token"])
 
-    app_log.debug("got new access token for".format(character.character_name))
+    store_access_token(character.character_id, response["access_token"], response["expires_in"])
 
-    session.add(character)
-    session.commit()
+    app_log.debug("got new access token for {}".format(character.character_name))
 
     return response["access_token"]
+
+
+def access_token(character, invalid=None):
+    """Get a valid access token for a character, refreshing it if needed. When
+       ESI rejected a token pass it as `invalid` so it gets replaced."""
+    token = _cached_access_token(character, invalid)
+
+    if token:
+        return token
+
+    if character.refresh_token is None:
+        app_log.warn("no refresh token for {}".format(character))
+        return None
+
+    deadline = time.time() + config.evesso_refresh_timeout
+
+    while time.time() < deadline:
+        lock = _lock(character)
+
+        if lock:
+            client = tornado.httpclient.HTTPClient()
+
+            try:
+                return _refresh_response(character, client.fetch(_refresh_request(character)))
+            finally:
+                client.close()
+                _unlock(character, lock)
+
+        # Another worker is refreshing this token, wait for it to show up
+        time.sleep(0.1)
+
+        token = _cached_access_token(character)
+
+        if token:
+            return token
+
+    app_log.warn("timed out waiting for an access token for {}".format(character))
+
+
+async def fetch_access_token(character, invalid=None):
+    """Get a valid access token for a character without blocking the IOLoop,
+       see `access_token`. Only a refresh goes to a thread."""
+    token = _cached_access_token(character, invalid)
+
+    if token:
+        return token
+
+    return await tornado.ioloop.IOLoop.current().run_in_executor(None, access_token, character)
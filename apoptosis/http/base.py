@@ -2,19 +2,151 @@ import tornado.ioloop
 import tornado.web
 import base64
 
+from tornado.httputil import url_concat
+
 import json
 
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from contextvars import copy_context
+except ImportError:
+    copy_context = None
+
+from sqlalchemy.orm import selectinload
+
 from apoptosis.models import (
     session,
+    begin_scope,
+    end_scope,
+    scope_statements,
+    principal,
     UserModel
 )
 
 from apoptosis.log import app_log
+from apoptosis import config
+
+
+executors = {}
+
+
+def executor(heavy=False):
+    """The database threads for light or heavy pages, None when database work
+       runs on the IOLoop. Heavy pages have threads of their own so they can
+       never hold up the light ones."""
+    if not config.database_workers or copy_context is None:
+        return None
+
+    name = "heavy" if heavy else "light"
+
+    if name not in executors:
+        executors[name] = ThreadPoolExecutor(
+            config.database_heavy_workers if heavy else config.database_workers,
+            thread_name_prefix="database-{}".format(name)
+        )
+
+    return executors[name]
+
+
+def load_user(user_id, options=()):
+    """A user with its characters, `options` are the loader options of the
+       page showing it."""
+    return session.query(UserModel).options(
+        selectinload(UserModel.characters), *options
+    ).filter(UserModel.id==user_id).first()
 
 
 class AuthPage(tornado.web.RequestHandler):
-    def prepare(self):
-        session.commit()
+    # Pages that only read can be served from the read replica
+    replica = False
+    # Pages with slow queries run them on the heavy database threads
+    heavy = False
+
+    # The most statements a page should run, pages going over it are logged.
+    # Every page has one, `tests/test_pages.py` holds them to it.
+    query_ceiling = None
+
+    # Pages that change the current user or show more of it than its
+    # principal holds, they get it as a model in `user` loaded with the
+    # loader options in `user_profile`
+    loads_user = False
+    user_profile = ()
+
+    session_scope = None
+    _user = None
+
+    async def prepare(self):
+        self.session_scope = begin_scope(replica=self.replica)
+
+        cookie = self.get_secure_cookie("user_id")
+
+        if not cookie:
+            self.current_user = None
+            return
+
+        user_id = int(cookie)
+
+        # The current user is its principal, which is cached so most pages
+        # never query the database to authorize
+        self.current_user = await self.run_query(principal, user_id)
+
+        if not self.current_user:
+            # This was a cookie for a non-existing user
+            app_log.warn("Cookie with id:{} was used to try to login but no user by that id".format(user_id))
+
+            self.clear_cookie("user_id")
+            self.redirect("/")
+            return
+
+        if self.loads_user:
+            self._user = await self.run_query(load_user, user_id, self.user_profile)
+
+    @property
+    def user(self):
+        """The current user as a model on pages that declare `loads_user` or
+           once `fetch_user` ran, None otherwise."""
+        return self._user
+
+    async def fetch_user(self):
+        """Load the current user as a model on a database thread for pages
+           that only need it on some of their paths."""
+        if self._user is None and self.current_user:
+            self._user = await self.run_query(load_user, self.current_user.id, self.user_profile)
+
+        return self._user
+
+    async def run_query(self, fn, *args):
+        """Run `fn` on a database thread with the session of this request, the
+           IOLoop keeps serving other requests meanwhile."""
+        pool = executor(self.heavy)
+
+        if pool is None:
+            return fn(*args)
+
+        return await tornado.ioloop.IOLoop.current().run_in_executor(pool, copy_context().run, fn, *args)
+
+    async def commit(self, then=None):
+        """Commit the session of this request on a database thread. Committing
+           expires everything loaded, `then` runs on the same thread right
+           after so what it reads is loaded there rather than on the IOLoop.
+           Returns what `then` returns."""
+        def commit():
+            session.commit()
+
+            if then is not None:
+                return then()
+
+        return await self.run_query(commit)
+
+    def on_finish(self):
+        statements = scope_statements()
+
+        if self.query_ceiling is not None and statements is not None and statements > self.query_ceiling:
+            app_log.warn("{} ran {} statements, more than its ceiling of {}".format(
+                type(self).__name__, statements, self.query_ceiling))
+
+        end_scope(self.session_scope)
 
     def requires_login(self):
         if not self.current_user:
@@ -36,9 +168,11 @@ class AuthPage(tornado.web.RequestHandler):
         if not self.current_user.is_special and not self.current_user.is_admin:
             raise tornado.web.HTTPError(403)
 
-    def model_by_id(self, model, argument):
+    async def model_by_id(self, model, argument, options=()):
         """Fetch a model instance by its primary key from the arguments. We also
-           verify if the current user is the owner of the model. XXX"""
+           verify if the current user is the owner of the model. XXX
+
+           `options` are the loader options of the page showing it."""
 
         # XXX verify current owner of the model (if it has a relationship with user)
         model_id = self.get_argument(argument, None)
@@ -46,40 +180,29 @@ class AuthPage(tornado.web.RequestHandler):
         if not model_id:
             raise tornado.web.HTTPError(404)
 
-        instance = session.query(model).filter(model.id==model_id).first()
+        instance = await self.run_query(lambda: session.query(model).options(*options).filter(model.id==model_id).first())
 
         if not instance:    
             raise tornado.web.HTTPError(404)
 
-        if hasattr(instance, "user"):
-            if not instance.user == self.current_user and not self.current_user.is_admin:
+        # Admins may see everything, their check doesn't need to load the owner
+        if not self.current_user.is_admin and hasattr(type(instance), "user"):
+            if not instance.user_id == self.current_user.id:
                 raise tornado.web.HTTPError(403)
 
         return instance
         
 
-    def write_error(self, status_code, **kwargs):
-        return self.render("{}.html".format(status_code))
-
-    def get_current_user(self):
-        cookie = self.get_secure_cookie("user_id")
-
-        if cookie:
-            user_id = int(self.get_secure_cookie("user_id"))
-        else:
-            return None
-
-        user = session.query(UserModel).filter(UserModel.id==user_id).first()
+    def listing_url(self, **arguments):
+        """The current page with some of its arguments replaced, arguments
+           set to None are left out."""
+        current = {name: self.get_argument(name) for name in self.request.arguments}
+        current.update(arguments)
 
-        if not user:
-            # This was a cookie for a non-existing user
-            app_log.warn("Cookie with id:{} was used to try to login but no user by that id".format(user_id))
-
-            self.clear_cookie("user_id")
-            return self.redirect("/")
-
-        return user
+        return url_concat(self.request.path, {name: value for name, value in current.items() if value is not None})
 
+    def write_error(self, status_code, **kwargs):
+        return self.render("{}.html".format(status_code))
 
     def set_current_user(self, user):
         if user is None:
@@ -0,0 +1,161 @@
+import json
+import base64
+
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+
+from sqlalchemy import func, and_, nullslast, tuple_
+from sqlalchemy.orm import aliased
+
+from apoptosis.models import session, UserModel, UserLoginModel, CharacterModel
+from apoptosis import config
+
+
+# A way to order a listing, by `column` and then by `key` which is unique.
+# `decode` turns a value from a cursor back into one of `column`.
+Sort = namedtuple("Sort", ["column", "key", "descending", "decode"])
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def _decode_date(value):
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f")
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+    return value
+
+
+def encode_cursor(value, key):
+    return base64.urlsafe_b64encode(json.dumps([_encode_value(value), key]).encode("utf-8")).decode("utf-8")
+
+
+def decode_cursor(cursor, sort):
+    try:
+        value, key = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")).decode("utf-8"))
+        return (None if value is None else sort.decode(value)), int(key)
+    except (TypeError, ValueError):
+        raise InvalidCursor(cursor)
+
+
+def _beyond(descending, column, value):
+    return column < value if descending else column > value
+
+
+def _rows(query, sort, limit):
+    order = [sort.column.desc(), sort.key.desc()] if sort.descending else [sort.column.asc(), sort.key.asc()]
+
+    return query.add_columns(sort.column, sort.key).order_by(nullslast(order[0]), order[1]).limit(limit).all()
+
+
+def paginate(query, sort, cursor=None, size=None):
+    """A page of `query` in the order of `sort` starting after `cursor`.
+       Rows without a value come last and are read as a segment of their own
+       so the rows with one are a single range of the index of the sort.
+       Returns the rows and the cursor of the next page or None."""
+    size = size or config.admin_page_size
+
+    if cursor:
+        value, key = decode_cursor(cursor, sort)
+        rows = []
+
+        if value is not None:
+            rows = _rows(query.filter(
+                _beyond(sort.descending, tuple_(sort.column, sort.key), tuple_(value, key))
+            ), sort, size + 1)
+            key = None
+
+        if len(rows) <= size:
+            empty = query.filter(sort.column.is_(None))
+
+            if key is not None:
+                empty = empty.filter(_beyond(sort.descending, sort.key, key))
+
+            rows += _rows(empty, sort, size + 1 - len(rows))
+    else:
+        rows = _rows(query, sort, size + 1)
+
+    following = encode_cursor(*rows[size - 1][-2:]) if len(rows) > size else None
+
+    return [row[0] for row in rows[:size]], following
+
+
+def _prefix(search):
+    """A LIKE pattern matching names starting with `search`, in lowercase."""
+    escaped = search.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return "{}%".format(escaped)
+
+
+character_name = func.lower(CharacterModel.character_name)
+
+character_sorts = OrderedDict([
+    ("name", Sort(character_name, CharacterModel.id, False, str)),
+    ("sp", Sort(CharacterModel.skillpoints, CharacterModel.id, True, int)),
+    ("corporation", Sort(CharacterModel.corporation_id, CharacterModel.id, False, int))
+])
+
+main_character = aliased(CharacterModel)
+main_character_name = func.lower(main_character.character_name)
+
+user_sorts = OrderedDict([
+    ("last_login", Sort(UserModel.last_login_date, UserModel.id, True, _decode_date)),
+    ("name", Sort(main_character_name, UserModel.id, False, str))
+])
+
+
+def characters(search=None, sort="name", cursor=None, user_id=None, options=()):
+    """A page of characters, optionally only those with a name starting with
+       `search` or those of a single user. `options` are the loader options
+       of the page showing them."""
+    query = session.query(CharacterModel).options(*options)
+
+    if user_id is not None:
+        query = query.filter(CharacterModel.user_id==user_id)
+
+    if search:
+        query = query.filter(character_name.like(_prefix(search), escape="\\"))
+
+    return paginate(query, character_sorts[sort], cursor)
+
+
+def users(search=None, sort="last_login", cursor=None, ip_address=None, options=()):
+    """A page of users, optionally only those with a main character with a
+       name starting with `search` or those that logged in from `ip_address`.
+       `options` are the loader options of the page showing them."""
+    query = session.query(UserModel).options(*options).outerjoin(
+        main_character, and_(main_character.user_id==UserModel.id, main_character.is_main)
+    )
+
+    if ip_address is not None:
+        query = query.filter(UserModel.id.in_(
+            session.query(UserLoginModel.user_id).filter(UserLoginModel.ip_address==ip_address)
+        ))
+
+    if search:
+        query = query.filter(main_character_name.like(_prefix(search), escape="\\"))
+
+    return paginate(query, user_sorts[sort], cursor)
+
+
+def logins(user_id, limit=20):
+    """The most recent logins of a user."""
+    return session.query(UserLoginModel).filter(
+        UserLoginModel.user_id==user_id
+    ).order_by(UserLoginModel.pub_date.desc()).limit(limit).all()
+
+
+def latest_logins(user_ids):
+    """The most recent login of every user by their id, in a single query."""
+    if not user_ids:
+        return {}
+
+    latest = session.query(func.max(UserLoginModel.id)).filter(
+        UserLoginModel.user_id.in_(user_ids)
+    ).group_by(UserLoginModel.user_id)
+
+    return {login.user_id: login for login in session.query(UserLoginModel).filter(UserLoginModel.id.in_(latest))}
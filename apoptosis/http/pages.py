@@ -12,11 +12,13 @@ from datetime import datetime
 import tornado.web
 import tornado.httpclient
 
+from sqlalchemy.orm import selectinload
+
 from apoptosis.log import app_log, sec_log
 from apoptosis.services import slack
 from apoptosis.cache import redis_cache
 from apoptosis import config
-from apoptosis.eve.sso import sso_auth, sso_login
+from apoptosis.eve.sso import sso_auth, sso_login, store_access_token
 
 from apoptosis.http.base import (
     AuthPage
@@ -30,9 +32,15 @@ from apoptosis.models import (
     CharacterModel,
     SlackIdentityModel,
     GroupModel,
-    MembershipModel
+    MembershipModel,
+    CharacterCorporationHistory,
+    CharacterLocationHistory,
+    CharacterSkillGroupModel,
+    glance
 )
 
+from apoptosis.http import listing
+
 import apoptosis.queue.user as queue_user 
 
 
@@ -56,6 +64,8 @@ def admin_required(func):
 
 
 class LoginPage(AuthPage):
+    query_ceiling = 1
+
     async def get(self):
         if self.current_user:
             return self.redirect("/")
@@ -64,6 +74,11 @@ class LoginPage(AuthPage):
 
 
 class LoginCallbackPage(AuthPage):
+    loads_user = True
+    # Adding a character also adds its corporation, alliance and scopes the
+    # first time they are seen
+    query_ceiling = 23
+
     async def get(self):
         # XXX do this depending on the code
 
@@ -111,6 +126,7 @@ class LoginCallbackPage(AuthPage):
 
         access_token = response["access_token"]
         refresh_token = response["refresh_token"]
+        expires_in = response["expires_in"]
 
         request = tornado.httpclient.HTTPRequest(
             "https://login.eveonline.com/oauth/verify",
@@ -126,15 +142,24 @@ class LoginCallbackPage(AuthPage):
         character_id = response["CharacterID"]
         character_scopes = response["Scopes"].split(" ")
 
+        store_access_token(character_id, access_token, expires_in)
+
         account_hash = response["CharacterOwnerHash"]
 
         return character_id, character_scopes, access_token, refresh_token, account_hash
 
     async def _create(self, character_id, character_scopes, access_token, refresh_token, account_hash): 
         # We don't have an account with this character on it yet. Let's fetch the 
-        # character information from the XML API and fill it into a model, tie it
-        # up to a fresh new user and log it in
-        character = await CharacterModel.from_api(character_id)
+        # character information from ESI and fill it into a model on a database
+        # thread, tie it up to a fresh new user and log it in
+        details = await CharacterModel.fetch_details(character_id)
+
+        return await self.run_query(
+            self._build, character_id, details, character_scopes, access_token, refresh_token, account_hash
+        )
+
+    def _build(self, character_id, details, character_scopes, access_token, refresh_token, account_hash):
+        character = CharacterModel.from_details(character_id, details)
         character.access_token = access_token
         character.refresh_token = refresh_token
         character.account_hash = account_hash
@@ -145,42 +170,53 @@ class LoginCallbackPage(AuthPage):
 
         return character
 
+    def _find(self, character_id):
+        """The character with this EVE id with its user and their characters,
+           everything the log lines show."""
+        return session.query(CharacterModel).options(
+            selectinload(CharacterModel.user).selectinload(UserModel.characters)
+        ).filter(CharacterModel.character_id==character_id).first()
+
     async def _add(self):
         character_id, character_scopes, access_token, refresh_token, account_hash = await self._sso_response()
 
         # See if we already have this character
-        character = session.query(CharacterModel).filter(CharacterModel.character_id==character_id).first()
+        character = await self.run_query(self._find, character_id)
+
+        user = await self.fetch_user()
 
         if character: # XXX add new scopes
-            if character.user == self.current_user:
+            if character.user_id == self.current_user.id:
                 # update scopes
                 a = 1
             else:
-                sec_log.warn("user {} tried to add {} but belongs to {}".format(self.current_user, character, character.user))
+                sec_log.warn("user {} tried to add {} but belongs to {}".format(user, character, character.user))
                 raise tornado.web.HTTPError(403)
         else:
             character = await self._create(character_id, character_scopes, access_token, refresh_token, account_hash)
 
         # Append the character to the currently logged in character
-        self.current_user.characters.append(character)
-        self.current_user.chg_date = datetime.now()
+        user.characters.append(character)
+        user.chg_date = datetime.now()
 
-        session.add(self.current_user)
-        session.commit()
+        session.add(user)
 
-        sec_log.info("added %s for %s" % (character, character.user))
-
-        queue_user.setup_character(character)
+        await self.commit(lambda: self._added(character))
 
         self.flash_success(self.locale.translate("CHARACTER_ADD_SUCCESS_ALERT"))
 
         self.redirect("/characters")
 
+    def _added(self, character):
+        sec_log.info("added %s for %s" % (character, character.user))
+
+        queue_user.setup_character(character)
+
     async def _login(self):
         character_id, character_scopes, access_token, refresh_token, account_hash = await self._sso_response()
 
         # See if we already have this character
-        character = session.query(CharacterModel).filter(CharacterModel.character_id==character_id).first()
+        character = await self.run_query(self._find, character_id)
 
         # The character already exists so we log in to the corresponding user and
         # redirect to the success page
@@ -192,18 +228,13 @@ class LoginCallbackPage(AuthPage):
             sec_log.info("logged in %s through %s" % (character.user, character))
             self.set_current_user(character.user)
 
-            login = UserLoginModel()
-            login.user = character.user
-            login.pub_date = datetime.now()
-            login.ip_address = self.request.remote_ip
-
-            session.add(login)
-            session.commit()
+            self._record_login(character.user)
+            await self.commit()
 
             return self.redirect("/login/success")
         else:
             # We don't have an account with this character on it yet. Let's fetch the 
-            # character information from the XML API and fill it into a model, tie it
+            # character information from ESI and fill it into a model, tie it
             # up to a fresh new user and log it in
             character = await self._create(character_id, character_scopes, access_token, refresh_token, account_hash)
             character.is_main = True
@@ -215,28 +246,39 @@ class LoginCallbackPage(AuthPage):
             user.chg_date = datetime.now()
 
             session.add(user)
-            session.commit()
-
-            self.set_current_user(user)
-
-            sec_log.info("created %s through %s" % (character.user, character))
 
-            login = UserLoginModel()
-            login.user = character.user
-            login.pub_date = datetime.now()
-            login.ip_address = self.request.remote_ip
+            # The user needs its id for the cookie, flushing gets it without
+            # committing twice
+            await self.run_query(session.flush)
 
-            session.add(login)
-            session.commit()
+            self.set_current_user(user)
 
-            queue_user.setup_character(character)
+            self._record_login(user)
+            await self.commit(lambda: self._created(character))
 
             # Redirect to another page with some more information for the user of what
             # is going on
             return self.redirect("/login/created")
 
+    def _record_login(self, user):
+        login = UserLoginModel()
+        login.user = user
+        login.pub_date = datetime.now()
+        login.ip_address = self.request.remote_ip
+
+        user.last_login_date = login.pub_date
+
+        session.add(login)
+
+    def _created(self, character):
+        sec_log.info("created %s through %s" % (character.user, character))
+
+        queue_user.setup_character(character)
+
 
 class LoginSuccessPage(AuthPage):
+    query_ceiling = 1
+
     @login_required
     async def get(self):
         self.flash_success(self.locale.translate("LOGIN_SUCCESS_ALERT"))
@@ -244,6 +286,8 @@ class LoginSuccessPage(AuthPage):
 
 
 class LoginCreatedPage(AuthPage):
+    query_ceiling = 1
+
     @login_required
     async def get(self):
         self.flash_success(self.locale.translate("LOGIN_CREATED_ALERT"))
@@ -251,6 +295,8 @@ class LoginCreatedPage(AuthPage):
 
 
 class LogoutPage(AuthPage):
+    query_ceiling = 1
+
     @login_required
     async def post(self):
         self.clear_cookie("user_id")
@@ -258,36 +304,44 @@ class LogoutPage(AuthPage):
 
 
 class LogoutSuccessPage(AuthPage):
+    query_ceiling = 1
+
     async def get(self):
         self.flash_success(self.locale.translate("LOGOUT_SUCCESS_ALERT"))
         return self.redirect("/")
 
 
 class HomePage(AuthPage):
+    query_ceiling = 1
+
     async def get(self):
         return self.render("home.html")
 
 
 class CharactersPage(AuthPage):
+    loads_user = True
+    query_ceiling = 3
 
     @login_required
     async def get(self):
-        return self.render("characters.html", login_url=sso_login)
+        return self.render("characters.html", user=self.user, login_url=sso_login)
 
 
 class CharactersSelectMainPage(AuthPage):
+    loads_user = True
+    query_ceiling = 4
 
     @login_required
     async def post(self):
-        character = self.model_by_id(CharacterModel, "character_id")
+        character = await self.model_by_id(CharacterModel, "character_id")
 
-        for char in self.current_user.characters:
+        for char in self.user.characters:
             char.is_main = False
 
         character.is_main = True
         
-        session.add(self.current_user)
-        session.commit()
+        session.add(self.user)
+        await self.commit()
 
         # TRIGGER LDAP
 
@@ -295,6 +349,8 @@ class CharactersSelectMainPage(AuthPage):
 
 
 class CharactersSelectMainSuccessPage(AuthPage):
+    query_ceiling = 1
+
     @login_required
     async def get(self):
         self.flash_success(self.locale.translate("CHARACTERS_CHARACTERS_MAIN_SELECT_SUCCESS"))
@@ -302,19 +358,23 @@ class CharactersSelectMainSuccessPage(AuthPage):
 
 
 class ServicesPage(AuthPage):
+    loads_user = True
+    user_profile = (selectinload(UserModel.slack_identities),)
+    query_ceiling = 4
 
     @login_required
     async def get(self):
-        return self.render("services.html")
+        return self.render("services.html", user=self.user)
 
 class ServicesDeleteSlackIdentityPage(AuthPage):
+    query_ceiling = 3
 
     @login_required
     async def post(self):
-        slackidentity = self.model_by_id(SlackIdentityModel, "slackidentity_id")
+        slackidentity = await self.model_by_id(SlackIdentityModel, "slackidentity_id")
 
         session.delete(slackidentity)
-        session.commit()
+        await self.commit()
 
         self.flash_success(self.locale.translate("SERVICES_DELETE_SLACK_IDENTITY_SUCCESS_ALERT"))
 
@@ -322,6 +382,8 @@ class ServicesDeleteSlackIdentityPage(AuthPage):
 
 
 class ServicesAddSlackIdentityPage(AuthPage):
+    loads_user = True
+    query_ceiling = 7
 
     @login_required
     async def post(self):
@@ -331,29 +393,37 @@ class ServicesAddSlackIdentityPage(AuthPage):
             raise tornado.web.HTTPError(400)
 
         slackidentity = SlackIdentityModel(slack_id)
-        slackidentity.user = self.current_user
+        slackidentity.user = self.user
 
         session.add(slackidentity)
-        session.commit()
+        slackidentity_id = await self.commit(lambda: self._added(slackidentity))
+
+        return self.redirect("/services/add_slack_identity/success?slackidentity_id={id}".format(id=slackidentity_id))
 
+    def _added(self, slackidentity):
         sec_log.info("slackidentity {} added to {}".format(slackidentity, slackidentity.user))
 
-        return self.redirect("/services/add_slack_identity/success?slackidentity_id={id}".format(id=slackidentity.id))
+        return slackidentity.id
 
 
 class ServicesAddSlackIdentitySuccessPage(AuthPage):
+    query_ceiling = 2
+
     @login_required
     async def get(self):
-        slackidentity = self.model_by_id(SlackIdentityModel, "slackidentity_id")
+        slackidentity = await self.model_by_id(SlackIdentityModel, "slackidentity_id")
         self.flash_success(self.locale.translate("SERVICES_ADD_SLACK_IDENTITY_SUCCESS_ALERT"))
         return self.redirect("/services")
 
 
 class ServicesSendVerificationSlackIdentityPage(AuthPage):
+    # The owner shows up in the log by its main character
+    profile = (selectinload(SlackIdentityModel.user).selectinload(UserModel.characters),)
+    query_ceiling = 4
 
     @login_required
     async def post(self):
-        slackidentity = self.model_by_id(SlackIdentityModel, "slackidentity_id")
+        slackidentity = await self.model_by_id(SlackIdentityModel, "slackidentity_id", self.profile)
 
         value = await slack.verify(slackidentity)
 
@@ -367,77 +437,93 @@ class ServicesSendVerificationSlackIdentityPage(AuthPage):
 
 
 class ServicesVerifyVerificationSlackIdentityPage(AuthPage):
+    query_ceiling = 6
 
     @login_required
     async def post(self):
         code = self.get_argument("code", None)
 
-        slackidentity = self.model_by_id(SlackIdentityModel, "slackidentity_id")
+        slackidentity = await self.model_by_id(SlackIdentityModel, "slackidentity_id")
 
         if slackidentity.verification_code == code:
             slackidentity.verification_done = True
 
             session.add(slackidentity)
-            session.commit()
+            slackidentity_id = await self.commit(lambda: self._verified(slackidentity))
 
-            sec_log.info("slackidentity {} for {} verified".format(slackidentity, slackidentity.user))
             self.flash_success(self.locale.translate("SERVICES_VERIFY_SLACK_IDENTITY_SUCCESS_ALERT"))
 
-            return self.redirect("/services?slackidentity_id={}".format(slackidentity.id))
+            return self.redirect("/services?slackidentity_id={}".format(slackidentity_id))
         else:
             self.flash_error(self.locale.translate("SERVICES_VERIFY_SLACK_IDENTITY_FAILURE_ALERT"))
             return self.redirect("/services?slackidentity_id={}".format(slackidentity.id))
 
+    def _verified(self, slackidentity):
+        sec_log.info("slackidentity {} for {} verified".format(slackidentity, slackidentity.user))
+
+        return slackidentity.id
+
 
 class ServicesVerifySlackIdentitySuccessPage(AuthPage):
+    query_ceiling = 2
+
     @login_required
     async def get(self):
-        slackidentity = self.model_by_id(SlackIdentityModel, "slackidentity_id")
+        slackidentity = await self.model_by_id(SlackIdentityModel, "slackidentity_id")
         self.flash_success(self.locale.translate("SERVICES_VERIFY_SLACK_IDENTITY_SUCCESS_ALERT"))
         return self.redirect("/services")
 
 
 class GroupsPage(AuthPage):
+    # Everything groups.html walks for a group
+    profile = (selectinload(GroupModel.memberships).selectinload(MembershipModel.user),)
+    query_ceiling = 4
 
     @login_required
     @internal_required
     async def get(self):
-        groups = session.query(GroupModel).all()
+        groups = await self.run_query(lambda: session.query(GroupModel).options(*self.profile).all())
 
         return self.render("groups.html", groups=groups)
 
 
 class GroupsJoinPage(AuthPage):
+    loads_user = True
+    query_ceiling = 9
 
     @login_required
     @internal_required
     async def post(self):
-        group = self.model_by_id(GroupModel, "group_id")
+        group = await self.model_by_id(GroupModel, "group_id")
 
         membership = MembershipModel()
-        membership.user = self.current_user
+        membership.user = self.user
         membership.group = group
 
         if group.requires_approval:
             membership.pending = True
 
         session.add(membership)
-        session.commit()
-
-        sec_log.info("user {} joined group {}".format(membership.user, membership.group))
+        membership_id = await self.commit(lambda: self._joined(membership))
 
         # XXX move to task
         #await slack.group_upkeep(group)
 
-        return self.redirect("/groups/join/success?membership_id={}".format(membership.id))
+        return self.redirect("/groups/join/success?membership_id={}".format(membership_id))
+
+    def _joined(self, membership):
+        sec_log.info("user {} joined group {}".format(membership.user, membership.group))
+
+        return membership.id
 
 
 class GroupsJoinSuccessPage(AuthPage):
+    query_ceiling = 2
 
     @login_required
     @internal_required
     async def get(self):
-        membership = self.model_by_id(MembershipModel, "membership_id")
+        membership = await self.model_by_id(MembershipModel, "membership_id")
         if membership.pending:
             self.flash_success(self.locale.translate("GROUPS_JOIN_SUCCESS_PENDING_ALERT"))
         else:
@@ -446,48 +532,59 @@ class GroupsJoinSuccessPage(AuthPage):
 
 
 class GroupsLeavePage(AuthPage):
+    # Members show up in the log by their main character
+    profile = (selectinload(GroupModel.memberships).selectinload(MembershipModel.user).selectinload(UserModel.characters),)
+    query_ceiling = 6
 
     @login_required
     @internal_required
     async def post(self):
-        group = self.model_by_id(GroupModel, "group_id")
+        group = await self.model_by_id(GroupModel, "group_id", self.profile)
+        group_id = group.id
 
         for membership in group.memberships:
-            if membership.user == self.current_user:
+            if membership.user_id == self.current_user.id:
+                left = "user {} left group {}".format(membership.user, group)
+
                 session.delete(membership)
-                session.commit()
+                await self.commit()
 
                 break
         else:
             raise tornado.web.HTTPError(400)
 
-        sec_log.info("user {} left group {}".format(membership.user, membership.group))
+        sec_log.info(left)
 
         # XXX move to task
         #await slack.group_upkeep(group)
 
-        return self.redirect("/groups/leave/success?group_id={}".format(group.id))
+        return self.redirect("/groups/leave/success?group_id={}".format(group_id))
 
 
 class GroupsLeaveSuccessPage(AuthPage):
+    query_ceiling = 2
 
     @login_required
     @internal_required
     async def get(self):
-        group = self.model_by_id(GroupModel, "group_id")
+        group = await self.model_by_id(GroupModel, "group_id")
         self.flash_success(self.locale.translate("GROUPS_LEAVE_SUCCESS_ALERT"))
         return self.redirect("/groups")
 
 
 class PingPage(AuthPage):
+    loads_user = True
+    user_profile = (selectinload(UserModel.memberships).selectinload(MembershipModel.group),)
+    query_ceiling = 4
 
     @login_required
     @internal_required
     async def get(self):
-        return self.render("ping.html")
+        return self.render("ping.html", user=self.user)
 
 
 class PingSendAllPage(AuthPage):
+    query_ceiling = 1
 
     @login_required
     @internal_required
@@ -497,7 +594,7 @@ class PingSendAllPage(AuthPage):
         if not message:
             raise tornado.web.HTTPError(400)
 
-        message = "{} ({})".format(message, self.current_user.main_character.character_name)
+        message = "{} ({})".format(message, self.current_user.main_character_name)
 
         result = await slack.group_ping("midnight-rodeo", message)
 
@@ -509,6 +606,7 @@ class PingSendAllPage(AuthPage):
 
 
 class PingSendAllSuccessPage(AuthPage):
+    query_ceiling = 1
 
     @login_required
     @internal_required
@@ -518,17 +616,18 @@ class PingSendAllSuccessPage(AuthPage):
 
 
 class PingSendGroupPage(AuthPage):
+    query_ceiling = 2
 
     @login_required
     @internal_required
     async def post(self):
         message = self.get_argument("message", None)
-        group = self.model_by_id(GroupModel, "group_id")
+        group = await self.model_by_id(GroupModel, "group_id")
 
         if not message:
             raise tornado.web.HTTPError(400)
 
-        message = "{} ({})".format(message, self.current_user.main_character.character_name)
+        message = "{} ({})".format(message, self.current_user.main_character_name)
 
         result = await slack.group_ping(group.slug, message)
 
@@ -540,93 +639,94 @@ class PingSendGroupPage(AuthPage):
 
 
 class PingSendGroupSuccessPage(AuthPage):
+    query_ceiling = 2
 
     @login_required
     @internal_required
     async def get(self):
-        group = self.model_by_id(GroupModel, "group_id")
+        group = await self.model_by_id(GroupModel, "group_id")
         self.flash_success("foo")
         return self.redirect("/groups")
 
 
 class AdminPage(AuthPage):
+    replica = True
+    heavy = True
+    query_ceiling = 5
 
     @login_required
     @internal_required
     @admin_required
     async def get(self):
-        characters = list(session.query(CharacterModel).all())
-        users = list(session.query(UserModel).all())
-        memberships = list(session.query(MembershipModel).all())
-
-        glance_total = len(characters)
-        glance_internal = len([character for character in characters if character.is_internal])
-        glance_user = len([character for character in characters if character.is_internal])
-        glance_membership = len([membership for membership in memberships if membership.pending])
-
-        return self.render(
-            "admin.html",
-            glance_total=glance_total,
-            glance_internal=glance_internal,
-            glance_user=glance_user,
-            glance_membership=glance_membership
-        )
+        return self.render("admin.html", **await self.run_query(glance))
 
 class AdminGroupsPage(AuthPage):
+    replica = True
+    heavy = True
+    profile = (selectinload(GroupModel.memberships),)
+    query_ceiling = 3
 
     @login_required
     @internal_required
     @admin_required
     async def get(self):
-        groups = session.query(GroupModel).all()
+        groups = await self.run_query(lambda: session.query(GroupModel).options(*self.profile).all())
 
         return self.render("admin_groups.html", groups=groups)
 
 class AdminGroupsManagePage(AuthPage):
+    # Members are shown by the name of their main character
+    profile = (selectinload(GroupModel.memberships).selectinload(MembershipModel.user).selectinload(UserModel.characters),)
+    query_ceiling = 5
 
     @login_required
     @internal_required
     @admin_required
     async def get(self):
-        group = self.model_by_id(GroupModel, "group_id")
+        group = await self.model_by_id(GroupModel, "group_id", self.profile)
 
         self.render("admin_groups_manage.html", group=group)
 
 
 class AdminMembershipAllowPage(AuthPage):
+    query_ceiling = 3
 
     @login_required
     @internal_required
     @admin_required
     async def post(self):
-        membership = self.model_by_id(MembershipModel, "membership_id")
+        membership = await self.model_by_id(MembershipModel, "membership_id")
         membership.pending = 0
 
+        group_id = membership.group_id
+
         session.add(membership)
-        session.commit()
+        await self.commit()
 
         self.flash_success(self.locale.translate("MEMBERSHIP_ALLOW_SUCCESS_ALERT"))
-        self.redirect("/admin/groups/manage?group_id={}".format(membership.group.id))
+        self.redirect("/admin/groups/manage?group_id={}".format(group_id))
 
 
 class AdminMembershipDenyPage(AuthPage):
+    query_ceiling = 3
 
     @login_required
     @internal_required
     @admin_required
     async def post(self):
-        membership = self.model_by_id(MembershipModel, "membership_id")
+        membership = await self.model_by_id(MembershipModel, "membership_id")
 
-        group_id = membership.group.id
+        group_id = membership.group_id
 
         session.delete(membership)
-        session.commit()
+        await self.commit()
 
         self.flash_success(self.locale.translate("MEMBERSHIP_DENY_SUCCESS_ALERT"))
         self.redirect("/admin/groups/manage?group_id={}".format(group_id))
 
 
 class AdminGroupsCreatePage(AuthPage):
+    query_ceiling = 2
 
     @login_required
     @internal_required
@@ -638,44 +738,177 @@ class AdminGroupsCreatePage(AuthPage):
         group.name = self.get_argument("group_name")
         group.slug = self.get_argument("group_slug")
         group.description = self.get_argument("group_description")
-        group.has_slack = self.get_argument("group_has_slack")
-        group.requires_approvial = self.get_argument("group_requires_approval")
+        # Checkboxes are only sent when checked
+        group.has_slack = self.get_argument("group_has_slack", None) is not None
+        group.requires_approval = self.get_argument("group_requires_approval", None) is not None
 
         session.add(group)
-        session.commit()
+        await self.commit()
 
         self.flash_success(self.locale.translate("GROUP_ADD_SUCCESS_ALERT"))
 
         self.redirect("/admin/groups")
 
 
+def listing_arguments(handler, sorts):
+    """The search, sort and cursor of a listing page from its arguments, the
+       first of `sorts` is the default."""
+    search = handler.get_argument("search", None)
+    sort = handler.get_argument("sort", next(iter(sorts)))
+    cursor = handler.get_argument("after", None)
+
+    if sort not in sorts:
+        raise tornado.web.HTTPError(400)
+
+    return search, sort, cursor
+
+
 class AdminUsersPage(AuthPage):
+    replica = True
+    heavy = True
+    # Everything admin_users.html walks for a user, their last logins are
+    # loaded in one go next to it
+    profile = (selectinload(UserModel.characters), selectinload(UserModel.memberships).selectinload(MembershipModel.group))
+    query_ceiling = 6
 
     @login_required
     @internal_required
     @admin_required
     async def get(self):
-        users = session.query(UserModel).all()
+        search, sort, cursor = listing_arguments(self, listing.user_sorts)
 
-        return self.render("admin_users.html", users=users)
+        try:
+            users, following, last_logins = await self.run_query(self.users, search, sort, cursor)
+        except listing.InvalidCursor:
+            raise tornado.web.HTTPError(400)
+
+        return self.render(
+            "admin_users.html",
+            users=users,
+            following=following,
+            last_logins=last_logins,
+            search=search,
+            address=None
+        )
+
+    def users(self, search, sort, cursor, address=None):
+        users, following = listing.users(search, sort, cursor, address, self.profile)
+        return users, following, listing.latest_logins([user.id for user in users])
+
+
+class AdminUsersIPAddressPage(AdminUsersPage):
+
+    @login_required
+    @internal_required
+    @admin_required
+    async def get(self):
+        address = self.get_argument("address")
+        search, sort, cursor = listing_arguments(self, listing.user_sorts)
+
+        try:
+            users, following, last_logins = await self.run_query(self.users, search, sort, cursor, address)
+        except listing.InvalidCursor:
+            raise tornado.web.HTTPError(400)
+
+        return self.render(
+            "admin_users.html",
+            users=users,
+            following=following,
+            last_logins=last_logins,
+            search=search,
+            address=address
+        )
+
+
+class AdminUsersDetailPage(AuthPage):
+    replica = True
+    heavy = True
+    profile = (selectinload(UserModel.characters), selectinload(UserModel.memberships).selectinload(MembershipModel.group))
+    query_ceiling = 7
+
+    @login_required
+    @internal_required
+    @admin_required
+    async def get(self):
+        user = await self.model_by_id(UserModel, "user_id", self.profile)
+        search, sort, cursor = listing_arguments(self, listing.character_sorts)
+
+        try:
+            (characters, following), logins = await self.run_query(lambda: (
+                listing.characters(search, sort, cursor, user.id),
+                listing.logins(user.id)
+            ))
+        except listing.InvalidCursor:
+            raise tornado.web.HTTPError(400)
+
+        return self.render(
+            "admin_users_detail.html",
+            user=user,
+            characters=characters,
+            following=following,
+            logins=logins
+        )
 
 
 class AdminCharactersPage(AuthPage):
+    replica = True
+    heavy = True
+    query_ceiling = 2
+
+    @login_required
+    @internal_required
+    @admin_required
+    async def get(self):
+        search, sort, cursor = listing_arguments(self, listing.character_sorts)
+
+        try:
+            characters, following = await self.run_query(listing.characters, search, sort, cursor)
+        except listing.InvalidCursor:
+            raise tornado.web.HTTPError(400)
+
+        return self.render(
+            "admin_characters.html",
+            characters=characters,
+            following=following,
+            search=search
+        )
+
+
+class AdminCharactersDetailPage(AuthPage):
+    replica = True
+    heavy = True
+    query_ceiling = 5
 
     @login_required
     @internal_required
     @admin_required
     async def get(self):
-        characters = session.query(CharacterModel).order_by(CharacterModel.character_name).all()
+        character = await self.model_by_id(CharacterModel, "character_id")
 
-        return self.render("admin_characters.html", characters=characters)
+        corporation_history, location_history, skill_groups = await self.run_query(lambda: (
+            CharacterCorporationHistory.recent(character).all(),
+            CharacterLocationHistory.recent(character).all(),
+            character.skill_groups.order_by(CharacterSkillGroupModel.points.desc()).all()
+        ))
+
+        return self.render(
+            "admin_characters_detail.html",
+            character=character,
+            corporation_history=corporation_history,
+            location_history=location_history,
+            skill_groups=skill_groups
+        )
 
 class AdminGroupsPage(AuthPage):
+    replica = True
+    heavy = True
+    profile = (selectinload(GroupModel.memberships),)
+    query_ceiling = 3
 
     @login_required
     @internal_required
     @admin_required
     async def get(self):
-        groups = session.query(GroupModel).all()
+        groups = await self.run_query(lambda: session.query(GroupModel).options(*self.profile).all())
 
         return self.render("admin_groups.html", groups=groups)
@@ -37,11 +37,14 @@ from apoptosis.http.pages import (
     AdminMembershipAllowPage,
     AdminMembershipDenyPage,
     AdminUsersPage,
+    AdminUsersDetailPage,
+    AdminUsersIPAddressPage,
     AdminCharactersPage,
-    AdminCharactersPage,
+    AdminCharactersDetailPage,
 )
 
 from apoptosis import config
+from apoptosis.models import preload_static_indexes
 from apoptosis.queue import user as queue_user
 from apoptosis.log import app_log
 
@@ -161,10 +164,22 @@ def make_app():
                 r"/admin/users",
                 AdminUsersPage 
             ),
+            (
+                r"/admin/users/detail",
+                AdminUsersDetailPage
+            ),
+            (
+                r"/admin/users/ip_address",
+                AdminUsersIPAddressPage
+            ),
             (
                 r"/admin/characters",
                 AdminCharactersPage 
             ),
+            (
+                r"/admin/characters/detail",
+                AdminCharactersDetailPage
+            ),
             (
                 r"/login",
                 LoginPage
@@ -203,6 +218,8 @@ def make_app():
 def main():
     app_log.info("starting application")
 
+    preload_static_indexes()
+
     app = make_app()
     app.listen(config.http_port)
 
@@ -1,34 +1,148 @@
 import os
+import json
+import time
+import threading
 
 import hashlib
 
-from sqlalchemy import BigInteger, Integer, Column, String, DateTime, ForeignKey, UniqueConstraint, Float, Boolean
-from sqlalchemy import create_engine, Text, Table, Boolean, func
+from collections import namedtuple
+from contextlib import contextmanager
 
-from sqlalchemy.orm import relationship, backref, joinedload
-from sqlalchemy.orm import backref, sessionmaker, scoped_session
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
+from sqlalchemy import BigInteger, Integer, Column, String, DateTime, Date, ForeignKey, UniqueConstraint, Float, Boolean, Index
+from sqlalchemy import create_engine, Text, Table, Boolean, func, event, and_, or_, exists, inspect, true
+
+from sqlalchemy.orm import relationship, backref, joinedload, aliased
+from sqlalchemy.orm import backref, sessionmaker, scoped_session, Session
+from sqlalchemy.sql.expression import UpdateBase, ColumnElement
+from sqlalchemy.sql.visitors import InternalTraversal
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.ext.compiler import compiles
 
 from datetime import datetime
 
 from apoptosis.exceptions import InvalidAPIKey
 
 from apoptosis.services import slack
+from apoptosis.cache import redis_cache
 from apoptosis import config
 
-import anoikis.api.eve as eve_api
-
-from anoikis.api.eve.esi import characters as esi_characters
+from apoptosis.eve import esi
 
 from anoikis.static.systems import system_name
 from anoikis.static.items import item_name
 
 
-engine = create_engine(config.database_uri)
-session = scoped_session(sessionmaker(autocommit=False,
+def _engine(uri):
+    """Create an engine with the pool settings from the config, SQLite has no
+       connection pool to tune."""
+    options = {"pool_recycle": config.database_pool_recycle, "pool_pre_ping": config.database_pool_pre_ping}
+
+    if not uri.startswith("sqlite"):
+        options.update(pool_size=config.database_pool_size, max_overflow=config.database_max_overflow)
+
+    return create_engine(uri, **options)
+
+
+engine = _engine(config.database_uri)
+replica_engine = _engine(config.database_replica_uri) if config.database_replica_uri else None
+
+
+class RoutingSession(Session):
+    """Reads go to the replica while `replica` is set in the info of the
+       session, writes and flushes always go to the primary."""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if replica_engine is not None and self.info.get("replica") and not self._flushing and not isinstance(clause, UpdateBase):
+            return replica_engine
+
+        return super().get_bind(mapper, clause=clause, **kwargs)
+
+
+class Scope(object):
+    """A request or task with a session of its own, counting the statements
+       it runs."""
+
+    def __init__(self):
+        self.statements = 0
+
+
+# Every request and task gets a session of its own through `begin_scope`,
+# anything outside of one shares a session per thread.
+session_scope = ContextVar("session_scope", default=None) if ContextVar else None
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    scope = session_scope.get() if session_scope is not None else None
+
+    if scope is not None:
+        scope.statements += 1
+
+
+def scope_statements():
+    """Statements run so far by the current request or task, None outside of
+       one."""
+    scope = session_scope.get() if session_scope is not None else None
+    return scope.statements if scope is not None else None
+
+
+def _current_scope():
+    scope = session_scope.get() if session_scope is not None else None
+    return scope if scope is not None else threading.get_ident()
+
+
+session = scoped_session(sessionmaker(class_=RoutingSession,
+                                      autocommit=False,
                                       autoflush=False,
-                                      bind=engine))
+                                      bind=engine), scopefunc=_current_scope)
+
+
+def begin_scope(replica=False):
+    """Give the current request or task a fresh session, reading from the
+       replica when `replica` is set. Returns a token for `end_scope`."""
+    if session_scope is None:
+        return None
+
+    token = session_scope.set(Scope())
+    session.info["replica"] = replica
+
+    return token
+
+
+def end_scope(token=None):
+    """Roll back whatever was left uncommitted and drop the session."""
+    if token is None:
+        # XXX without contextvars the session is shared by everything running
+        # on this thread so it can only be rolled back, not dropped
+        session.rollback()
+        return
+
+    session.remove()
+    session_scope.reset(token)
+
+
+@contextmanager
+def primary():
+    """Read from the primary within this block, also in a scope that reads
+       from the replica. For results that are cached, a lagging replica would
+       cache what was just changed as it was."""
+    replica = session.info.get("replica", False)
+    session.info["replica"] = False
+
+    try:
+        yield
+    finally:
+        session.info["replica"] = replica
+
 
 # XXX TODO MOVE TO CONFIG
 GROUP_MAP = {
@@ -49,21 +163,72 @@ class Base(object):
 Base = declarative_base(cls=Base)
 
 
+class HistoryMixin(object):
+    """History of a character ordered by the column named in `time`. The
+       relationship back to the character is a query in that order, and the
+       table is indexed on the character and `time` so the latest entry or a
+       range of entries is looked up without loading the rest."""
+
+    @declared_attr
+    def __table_args__(cls):
+        return (Index("ix_{}_character_{}".format(cls.__tablename__, cls.time), "character_id", cls.time, "id"),)
+
+    @classmethod
+    def history(cls, character):
+        return session.query(cls).filter(cls.character_id==character.id)
+
+    @classmethod
+    def recent(cls, character, limit=20):
+        """The most recent entries for a character, newest first."""
+        time = getattr(cls, cls.time)
+        return cls.history(character).order_by(time.desc(), cls.id.desc()).limit(limit)
+
+    @classmethod
+    def latest(cls, character):
+        """The most recent entry for a character or None."""
+        return cls.recent(character, 1).first()
+
+    @classmethod
+    def between(cls, character, start, end=None):
+        """Entries for a character from `start` up to `end`, oldest first."""
+        time = getattr(cls, cls.time)
+        query = cls.history(character).filter(time >= start)
+
+        if end is not None:
+            query = query.filter(time < end)
+
+        return query.order_by(time, cls.id)
+
+
+def history_backref(name, history):
+    """Backref from a character to its history as an ordered query, `history`
+       returns the history model once it is defined."""
+    return backref(name, lazy="dynamic", order_by=lambda: [getattr(history(), history().time), history().id])
+
+
 class UserModel(Base):
     pub_date = Column(DateTime)
     chg_date = Column(DateTime)
 
     is_admin = Column(Boolean)
 
+    # Kept with every login so users can be listed by it without aggregating
+    # their logins
+    last_login_date = Column(DateTime)
+
     is_special = Column(Boolean)  # XXX move to calculated property
     is_hr = Column(Boolean)  # XXX move to calculated property
 
-    @property
+    @hybrid_property
     def is_internal(self):
         # If any character on any active SSO or API token is in the
         # configured alliance or corp then this is an internal user
         # who has access to all features
-        return any(c.is_internal for c in self.characters)
+        return session.query(UserModel.is_internal).filter(UserModel.id==self.id).scalar()
+
+    @is_internal.expression
+    def is_internal(cls):
+        return exists().where(CharacterModel.user_id==cls.id).where(CharacterModel.is_internal)
 
     @property
     def main_character(self):
@@ -84,6 +249,11 @@ class UserModel(Base):
 
 
 class UserLoginModel(Base):
+    __table_args__ = (
+        Index("ix_userlogin_user_pub_date", "user_id", "pub_date"),
+        Index("ix_userlogin_ip_address_user", "ip_address", "user_id")
+    )
+
     pub_date = Column(DateTime)
 
     user_id = Column(Integer, ForeignKey("user.id"))
@@ -115,7 +285,9 @@ class ESIScopeModel(Base):
 
 class CharacterModel(Base):
     user_id = Column(Integer, ForeignKey("user.id"))
-    user = relationship("UserModel", backref="characters")
+    # The previous user is loaded when a character moves so its principal
+    # can be dropped as well
+    user = relationship("UserModel", backref="characters", active_history=True)
 
     is_main = Column(Boolean)
 
@@ -130,6 +302,17 @@ class CharacterModel(Base):
     alliance_id = Column(BigInteger)
     alliance_name = Column(String)
 
+    # Where the pollers last saw the character, kept here so listing characters
+    # doesn't have to go through their history
+    corporation_id = Column(Integer, ForeignKey("evecorporation.id"))
+    corporation = relationship("EVECorporationModel")
+
+    system_id = Column(Integer, ForeignKey("evesolarsystem.id"))
+    eve_type_id = Column(Integer, ForeignKey("evetype.id"))
+    eve_item_id = Column(BigInteger)
+
+    skillpoints = Column(BigInteger)
+
     def update_scopes(self, character_scopes):
         for esiscope in character_scopes:
             esiscope_model = session.query(ESIScopeModel).filter(ESIScopeModel.name==esiscope).first()
@@ -141,60 +324,80 @@ class CharacterModel(Base):
 
 
     @classmethod
-    async def from_api(cls, character_id):
-        """Instantiate a new character model from the public EVE ESI
-           API through its character id."""
+    async def fetch_details(cls, character_id):
+        """The public details of a character from the EVE ESI API with the
+           names of its corporation and alliance, everything `from_details`
+           would otherwise have to request."""
+        details = await esi.fetch_character("corporation", character_id)
 
-        instance = cls()
+        eve_ids = [details["corporation_id"]]
+
+        if "alliance_id" in details:
+            eve_ids.append(details["alliance_id"])
+
+        details["names"] = await esi.fetch_names(eve_ids)
+
+        return details
+
+    @classmethod
+    def from_details(cls, character_id, details):
+        """Instantiate a new character model from the details `fetch_details`
+           got for its character id."""
 
-        character = esi_characters.detail(character_id) # XXX replace fully
+        instance = cls()
 
         instance.character_id = character_id
-        instance.character_name = character["name"]
+        instance.character_name = details["name"]
 
-        corporation = EVECorporationModel.from_id(character["corporation_id"])
+        corporation_id = EVECorporationModel.index.lookup([details["corporation_id"]], details["names"])[details["corporation_id"]]
 
-        history_entry = CharacterCorporationHistory(instance, corporation)
+        history_entry = CharacterCorporationHistory(instance)
+        history_entry.corporation_id = corporation_id
         history_entry.join_date = datetime.now()  # XXX fetch this from the actual join date?
 
-        if "alliance_id" in character:
-            # XXX history instance
-            alliance = eve_api.alliance_detail(character["alliance_id"])
+        instance.corporation_id = corporation_id
 
-            instance.alliance_id = character["alliance_id"]
-            instance.alliance_name = alliance["alliance_name"]
+        if "alliance_id" in details:
+            # XXX history instance
+            instance.alliance_id = details["alliance_id"]
+            instance.alliance_name = EVEAllianceModel.index.name(
+                EVEAllianceModel.index.lookup([details["alliance_id"]], details["names"])[details["alliance_id"]]
+            )
 
         return instance
 
     @property
-    def corporation(self):
-        if len(self.corporation_history):
-            return self.corporation_history[-1].corporation
-        else:
-            return None
+    def corporation_name(self):
+        return EVECorporationModel.index.name(self.corporation_id)
+
+    @property
+    def system_name(self):
+        return EVESolarSystemModel.index.name(self.system_id)
+
+    @property
+    def eve_type_name(self):
+        return EVETypeModel.index.name(self.eve_type_id)
+
+    @property
+    def last_session(self):
+        return CharacterSessionHistory.latest(self)
 
     @property
     def is_online(self):
-        print(self.session_history)
-        return len(self.session_history) and self.session_history[-1].sign_out is None
+        last_session = self.last_session
+        return last_session is not None and last_session.sign_out is None
 
     @property
     def last_location(self):
-        if len(self.location_history):
-            return self.location_history[-1]
-        else:
-            return None
+        return CharacterLocationHistory.latest(self)
 
     @property
     def last_ship(self):
-        if len(self.ship_history):
-            return self.ship_history[-1]
-        else:
-            return None
+        return CharacterShipHistory.latest(self)
 
     @property
     def sp(self):
-        return sum(s.points for s in self.skills)
+        return self.skillpoints
 
     @property
     def has_public_scopes(self):
@@ -214,17 +417,54 @@ class CharacterModel(Base):
     def __hash__(self):
         return hash((self.user.id, self.character_id))
 
-    @property
+    @hybrid_property
     def is_internal(self):
-        return self.corporation.name == "Hard Knocks Inc."  # XXX get from config
+        return self.corporation_id in internal_corporation_ids() or self.alliance_id in config.internal_alliance_ids
+
+    @is_internal.expression
+    def is_internal(cls):
+        return or_(cls.corporation_id.in_(internal_corporation_ids()), cls.alliance_id.in_(config.internal_alliance_ids))
 
     def __repr__(self):
         return "<CharacterModel(id={}) {}>".format(self.id, self.character_name)
 
 
-class CharacterCorporationHistory(Base):
+class descending(ColumnElement):
+    """A column of an index in descending order with rows without a value
+       last, the order the descending sorts of the admin listings use."""
+    inherit_cache = True
+    _traverse_internals = [("column", InternalTraversal.dp_clauseelement)]
+
+    def __init__(self, column):
+        self.column = column
+
+
+@compiles(descending)
+def compile_descending(element, compiler, **kw):
+    return "{} DESC NULLS LAST".format(compiler.process(element.column, **kw))
+
+
+@compiles(descending, "sqlite")
+def compile_descending_sqlite(element, compiler, **kw):
+    # SQLite has no NULLS LAST in indexes, NULL sorts lowest there already
+    return "{} DESC".format(compiler.process(element.column, **kw))
+
+
+# Every sort of the admin listings has an index ending in the primary key in
+# the order of the sort so a page continues where the last one ended without
+# counting rows. XXX on PostgreSQL prefix searches only use the name index in
+# the C locale
+Index("ix_character_name", func.lower(CharacterModel.character_name), CharacterModel.id)
+Index("ix_character_skillpoints", descending(CharacterModel.skillpoints), CharacterModel.id.desc())
+Index("ix_character_corporation", CharacterModel.corporation_id, CharacterModel.id)
+Index("ix_user_last_login_date", descending(UserModel.last_login_date), UserModel.id.desc())
+
+
+class CharacterCorporationHistory(HistoryMixin, Base):
+    time = "join_date"
+
     character_id = Column(Integer, ForeignKey("character.id"))
-    character = relationship("CharacterModel", backref="corporation_history")
+    character = relationship("CharacterModel", backref=history_backref("corporation_history", lambda: CharacterCorporationHistory))
 
     corporation_id = Column(Integer, ForeignKey("evecorporation.id"))
     corporation = relationship("EVECorporationModel")
@@ -232,14 +472,23 @@ class CharacterCorporationHistory(Base):
     join_date = Column(DateTime)
     exit_date = Column(DateTime)
 
-    def __init__(self, character, corporation):
+    def __init__(self, character, corporation=None):
         self.character = character
-        self.corporation = corporation
 
+        if corporation is not None:
+            self.corporation = corporation
+            self.corporation_id = corporation.id
+
+    @property
+    def corporation_name(self):
+        return EVECorporationModel.index.name(self.corporation_id)
+
+
+class CharacterAllianceHistory(HistoryMixin, Base):
+    time = "join_date"
 
-class CharacterAllianceHistory(Base):
     character_id = Column(Integer, ForeignKey("character.id"))
-    character = relationship("CharacterModel", backref="alliance_history")
+    character = relationship("CharacterModel", backref=history_backref("alliance_history", lambda: CharacterAllianceHistory))
 
     alliance_id = Column(Integer, ForeignKey("evealliance.id"))
     alliance = relationship("EVEAllianceModel")
@@ -251,24 +500,36 @@ class CharacterAllianceHistory(Base):
         self.character = character
         self.alliance = alliance
 
-class CharacterLocationHistory(Base):
+class CharacterLocationHistory(HistoryMixin, Base):
+    time = "when"
+
     character_id = Column(Integer, ForeignKey("character.id"))
-    character = relationship("CharacterModel", backref="location_history")
+    character = relationship("CharacterModel", backref=history_backref("location_history", lambda: CharacterLocationHistory))
 
     system_id = Column(Integer, ForeignKey("evesolarsystem.id"))
     system = relationship("EVESolarSystemModel")
 
     when = Column(DateTime)
 
-    def __init__(self, character, system):
+    def __init__(self, character, system=None):
         self.character = character
-        self.system = system
+
+        if system is not None:
+            self.system = system
+            self.system_id = system.id
+
         self.when = datetime.now()
 
+    @property
+    def system_name(self):
+        return EVESolarSystemModel.index.name(self.system_id)
+
+
+class CharacterShipHistory(HistoryMixin, Base):
+    time = "when"
 
-class CharacterShipHistory(Base):
     character_id = Column(Integer, ForeignKey("character.id"))
-    character = relationship("CharacterModel", backref="ship_history")
+    character = relationship("CharacterModel", backref=history_backref("ship_history", lambda: CharacterShipHistory))
 
     eve_type_id = Column(Integer, ForeignKey("evetype.id"))
     eve_type = relationship("EVETypeModel")
@@ -277,15 +538,63 @@ class CharacterShipHistory(Base):
 
     when = Column(DateTime)
 
-    def __init__(self, character, eve_type):
+    def __init__(self, character, eve_type=None):
         self.character = character
-        self.eve_type = eve_type
+
+        if eve_type is not None:
+            self.eve_type = eve_type
+            self.eve_type_id = eve_type.id
+
         self.when = datetime.now()
 
+    @property
+    def eve_type_name(self):
+        return EVETypeModel.index.name(self.eve_type_id)
+
+
+class CharacterLocationDay(Base):
+    """Location history rolled up per day once the raw entries are removed."""
+    __table_args__ = (UniqueConstraint("character_id", "day", "system_id"),)
 
-class CharacterSessionHistory(Base):
     character_id = Column(Integer, ForeignKey("character.id"))
-    character = relationship("CharacterModel", backref="session_history")
+    character = relationship("CharacterModel")
+
+    day = Column(Date)
+
+    system_id = Column(Integer, ForeignKey("evesolarsystem.id"))
+
+    visits = Column(Integer)
+    seconds = Column(Integer)
+
+    @property
+    def system_name(self):
+        return EVESolarSystemModel.index.name(self.system_id)
+
+
+class CharacterShipDay(Base):
+    """Ship history rolled up per day once the raw entries are removed."""
+    __table_args__ = (UniqueConstraint("character_id", "day", "eve_type_id"),)
+
+    character_id = Column(Integer, ForeignKey("character.id"))
+    character = relationship("CharacterModel")
+
+    day = Column(Date)
+
+    eve_type_id = Column(Integer, ForeignKey("evetype.id"))
+
+    visits = Column(Integer)
+    seconds = Column(Integer)
+
+    @property
+    def eve_type_name(self):
+        return EVETypeModel.index.name(self.eve_type_id)
+
+
+class CharacterSessionHistory(HistoryMixin, Base):
+    time = "sign_in"
+
+    character_id = Column(Integer, ForeignKey("character.id"))
+    character = relationship("CharacterModel", backref=history_backref("session_history", lambda: CharacterSessionHistory))
 
     sign_in = Column(DateTime)
     sign_out = Column(DateTime)
@@ -296,7 +605,7 @@ class CharacterSessionHistory(Base):
 
 class CharacterSkillModel(Base):
     character_id = Column(Integer, ForeignKey("character.id"))
-    character = relationship("CharacterModel", backref="skills")
+    character = relationship("CharacterModel", backref=backref("skills", lazy="dynamic", order_by="CharacterSkillModel.eve_skill_id"))
 
     eve_skill_id = Column(Integer, ForeignKey("eveskill.id"))
     eve_skill = relationship("EVESkillModel")
@@ -309,6 +618,26 @@ class CharacterSkillModel(Base):
         self.character = character
 
 
+class CharacterSkillGroupModel(Base):
+    """Skillpoints of a character per skill group, kept up to date by the skill
+       sync so characters can be ranked and filtered on them in SQL."""
+    __table_args__ = (
+        UniqueConstraint("character_id", "group_id"),
+        Index("ix_characterskillgroup_group_points", "group_id", "points")
+    )
+
+    character_id = Column(Integer, ForeignKey("character.id"))
+    character = relationship("CharacterModel", backref=backref("skill_groups", lazy="dynamic"))
+
+    group_id = Column(Integer, ForeignKey("eveskillgroup.id"))
+
+    points = Column(BigInteger)
+
+    @property
+    def group_name(self):
+        return EVESkillGroupModel.index.name(self.group_id)
+
+
 class GroupModel(Base):
     name = Column(String)
     slug = Column(String)
@@ -329,14 +658,14 @@ class GroupModel(Base):
 
     def has_member(self, user):
         for membership in self.memberships:
-            if membership.user == user and not membership.pending:
+            if membership.user_id == user.id and not membership.pending:
                 return True
 
         return False
 
     def has_pending(self, user):
         for membership in self.memberships:
-            if membership.user == user and membership.pending:
+            if membership.user_id == user.id and membership.pending:
                 return True
 
         return False
@@ -382,77 +711,168 @@ class SlackIdentityModel(Base):
             self.verification_sent = True
 
 
-class EVESolarSystemModel(Base):
-    eve_id = Column(BigInteger)
-    eve_name = Column(String)
+class StaticIndex(object):
+    """Keeps a static EVE table in memory as eve id -> primary key and primary
+       key -> name, without holding on to any model instances. These tables
+       only ever grow, they are loaded in full at startup and rows added since
+       are loaded as they are first asked for. Eve ids
+       that are not in the table yet are named through `resolve`, which takes
+       a list of eve ids and returns their names by eve id, and inserted. Names
+       that need a request can also be resolved without blocking through
+       `fetch`."""
 
-    @classmethod
-    def from_id(cls, eve_id):
-        instance = session.query(cls).filter(cls.eve_id==eve_id).first()
+    def __init__(self, model, name, resolve, fetch=None):
+        self.model = model
+        self.name_column = getattr(model, name)
+        self.resolve = resolve
+        self.fetch = fetch
 
-        if not instance:
-            instance = cls()
-            instance.eve_id = eve_id
-            instance.eve_name = system_name(eve_id)
+        self.reset()
 
-        return instance
+    def reset(self):
+        self.ids = {}
+        self.names = {}
 
+    def pending(self):
+        """Rows this index inserted in the transaction of the current session as
+           eve id -> primary key and primary key -> name. Other sessions don't
+           see them until they are committed."""
+        return session.info.setdefault("static_pending", {}).setdefault(self, ({}, {}))
 
-class EVETypeModel(Base):
-    eve_id = Column(BigInteger)
-    eve_name = Column(String)
+    def load(self, criterion, into=None):
+        ids, names = into or (self.ids, self.names)
 
-    @classmethod
-    def from_id(cls, eve_id):
-        instance = session.query(cls).filter(cls.eve_id==eve_id).first()
+        rows = session.query(self.model.id, self.model.eve_id, self.name_column).filter(criterion)
 
-        if not instance:
-            instance = cls()
-            instance.eve_id = eve_id
-            instance.eve_name = item_name(eve_id)
+        for instance_id, eve_id, name in rows:
+            ids[eve_id] = instance_id
+            names[instance_id] = name
 
-        return instance
+    def preload(self):
+        self.load(true())
 
+    def unknown(self, eve_ids):
+        """Eve ids that have no row yet."""
+        pending, _ = self.pending()
+        missing = set(eve_id for eve_id in eve_ids if eve_id not in self.ids and eve_id not in pending)
 
-class EVECharacterModel(Base):
-    eve_id = Column(BigInteger)
-    eve_name = Column(String)
+        if missing:
+            # Other processes might have added them since we last looked
+            self.load(self.model.eve_id.in_(missing))
 
+        return [eve_id for eve_id in missing if eve_id not in self.ids]
 
-class EVECorporationModel(Base):
-    eve_id = Column(BigInteger)
-    name = Column(String)
+    def _insert(self, eve_ids, names):
+        if not eve_ids:
+            return
+
+        # A savepoint keeps the transaction of the caller usable when another
+        # process inserted one of these first
+        with session.begin_nested():
+            session.execute(self.model.__table__.insert(), [
+                {"eve_id": eve_id, self.name_column.key: names.get(eve_id)} for eve_id in eve_ids
+            ])
+
+        self.load(self.model.eve_id.in_(eve_ids), self.pending())
+
+    def lookup(self, eve_ids, names=None):
+        """Map eve ids to primary keys, rows for unknown eve ids are created with
+           a single insert. `names` can hold names resolved beforehand."""
+        missing = self.unknown(eve_ids)
 
+        if missing:
+            names = dict(names or {})
+            unresolved = [eve_id for eve_id in missing if eve_id not in names]
+
+            if unresolved:
+                names.update(self.resolve(unresolved))
+
+            try:
+                self._insert(missing, names)
+            except IntegrityError:
+                # Some were inserted elsewhere since, only add the rest
+                self._insert(self.unknown(missing), names)
+
+        pending, _ = self.pending()
+
+        return {eve_id: self.ids[eve_id] if eve_id in self.ids else pending[eve_id] for eve_id in eve_ids}
+
+    async def lookup_async(self, eve_ids):
+        """Map eve ids to primary keys like `lookup` without blocking the IOLoop
+           on name requests."""
+        missing = self.unknown(eve_ids)
+        names = None
+
+        if missing and self.fetch is not None:
+            names = await self.fetch(missing)
+
+        return self.lookup(eve_ids, names)
+
+    def id(self, eve_id):
+        return self.lookup([eve_id])[eve_id]
+
+    async def id_async(self, eve_id):
+        return (await self.lookup_async([eve_id]))[eve_id]
+
+    def name(self, instance_id):
+        _, pending = self.pending()
+
+        if instance_id in pending:
+            return pending[instance_id]
+
+        if instance_id is not None and instance_id not in self.names:
+            self.load(self.model.id == instance_id)
+
+        return self.names.get(instance_id)
+
+    def eve_name(self, eve_id):
+        return self.name(self.id(eve_id))
+
+
+class StaticMixin(object):
     @classmethod
     def from_id(cls, eve_id):
-        instance = session.query(cls).filter(cls.eve_id==eve_id).first()
+        return session.query(cls).get(cls.index.id(eve_id))
 
-        if not instance:
-            instance = cls()
-            instance.eve_id = eve_id
-            instance.name = eve_api.corporation_detail(eve_id)["corporation_name"]
+    @classmethod
+    async def fetch_from_id(cls, eve_id):
+        return session.query(cls).get(await cls.index.id_async(eve_id))
 
-        return instance
+
+class EVESolarSystemModel(StaticMixin, Base):
+    eve_id = Column(BigInteger, unique=True)
+    eve_name = Column(String)
 
 
-class EVESkillModel(Base):
+class EVETypeModel(StaticMixin, Base):
+    eve_id = Column(BigInteger, unique=True)
+    eve_name = Column(String)
+
+
+class EVECharacterModel(Base):
     eve_id = Column(BigInteger)
     eve_name = Column(String)
 
-    @classmethod
-    def from_id(cls, eve_id):
-        instance = session.query(cls).filter(cls.eve_id==eve_id).first()
 
-        if not instance:
-            instance = cls()
-            instance.eve_id = eve_id
-            instance.eve_name = item_name(eve_id)
+class EVECorporationModel(StaticMixin, Base):
+    eve_id = Column(BigInteger, unique=True)
+    name = Column(String)
 
-        return instance
 
+class EVESkillGroupModel(StaticMixin, Base):
+    eve_id = Column(BigInteger, unique=True)
+    eve_name = Column(String)
 
-class EVEAllianceModel(Base):
-    eve_id = Column(BigInteger)
+
+class EVESkillModel(StaticMixin, Base):
+    eve_id = Column(BigInteger, unique=True)
+    eve_name = Column(String)
+
+    group_id = Column(Integer, ForeignKey("eveskillgroup.id"))
+
+
+class EVEAllianceModel(StaticMixin, Base):
+    eve_id = Column(BigInteger, unique=True)
     eve_name = Column(String)
 
 
@@ -470,5 +890,202 @@ class LocalScanMembershipModel(Base):
     when = Column(DateTime)
 
 
+# Internal corporations that had no row yet by eve id and when they were last
+# looked for, they are looked for again at most every `unseen_interval` seconds
+unseen_interval = 60
+unseen_corporations = {}
+
+
+def internal_corporation_ids():
+    """Primary keys of the configured internal corporations, those that have
+       not been seen yet are left out."""
+    index = EVECorporationModel.index
+    eve_ids = config.internal_corporation_ids
+    now = time.time()
+
+    missing = []
+
+    for eve_id in eve_ids:
+        if eve_id in index.ids:
+            unseen_corporations.pop(eve_id, None)
+        elif now - unseen_corporations.get(eve_id, 0) >= unseen_interval:
+            missing.append(eve_id)
+
+    if missing:
+        for eve_id in index.unknown(missing):
+            unseen_corporations[eve_id] = now
+
+    return [index.ids[eve_id] for eve_id in eve_ids if eve_id in index.ids]
+
+
+def static_names(name):
+    """Resolve names one by one from the static data, these are local."""
+    return lambda eve_ids: {eve_id: name(eve_id) for eve_id in eve_ids}
+
+
+EVESolarSystemModel.index = StaticIndex(EVESolarSystemModel, "eve_name", static_names(system_name))
+EVETypeModel.index = StaticIndex(EVETypeModel, "eve_name", static_names(item_name))
+EVESkillModel.index = StaticIndex(EVESkillModel, "eve_name", static_names(item_name))
+EVESkillGroupModel.index = StaticIndex(EVESkillGroupModel, "eve_name", lambda eve_ids: {
+    eve_id: esi.request("/universe/groups/{}/".format(eve_id))["name"] for eve_id in eve_ids
+})
+EVECorporationModel.index = StaticIndex(EVECorporationModel, "name", esi.names, esi.fetch_names)
+EVEAllianceModel.index = StaticIndex(EVEAllianceModel, "eve_name", esi.names, esi.fetch_names)
+
+static_indexes = [
+    EVESolarSystemModel.index,
+    EVETypeModel.index,
+    EVESkillModel.index,
+    EVESkillGroupModel.index,
+    EVECorporationModel.index,
+    EVEAllianceModel.index
+]
+
+
+# Releasing or rolling back a savepoint fires these events as well, only
+# the outermost transaction counts
+@event.listens_for(session.session_factory, "after_commit")
+def commit_static_indexes(current_session):
+    if current_session.in_nested_transaction():
+        return
+
+    # Rows this session inserted are there for every session now
+    for index, (ids, names) in current_session.info.pop("static_pending", {}).items():
+        index.ids.update(ids)
+        index.names.update(names)
+
+
+@event.listens_for(session.session_factory, "after_rollback")
+def rollback_static_indexes(current_session):
+    if current_session.in_nested_transaction():
+        return
+
+    # Rows this session inserted are gone with the transaction
+    current_session.info.pop("static_pending", None)
+
+
+def preload_static_indexes():
+    """Load every static index in full, done once when a web server or worker
+       starts."""
+    scope = begin_scope()
+
+    try:
+        for index in static_indexes:
+            index.preload()
+    finally:
+        end_scope(scope)
+
+
+glance_key = "apoptosis:admin:glance"
+principal_key = "apoptosis:principal:{}"
+
+# The models the admin dashboard counts and the principals of users are built
+# from, with the columns they depend on. Adding or removing a row or changing
+# one of these columns drops what is cached.
+cached_columns = {
+    CharacterModel: ("user_id", "is_main", "character_name", "corporation_id", "alliance_id"),
+    UserModel: ("is_admin", "is_hr", "is_special"),
+    MembershipModel: ("user_id", "pending")
+}
+
+
+def glance():
+    """The counts on the admin dashboard, cached until characters, users or
+       memberships change."""
+    cached = redis_cache.get(glance_key)
+
+    if cached:
+        return json.loads(cached.decode("utf-8"))
+
+    with primary():
+        counts = {
+            "glance_total": session.query(func.count(CharacterModel.id)).scalar(),
+            "glance_internal": session.query(func.count(CharacterModel.id)).filter(CharacterModel.is_internal).scalar(),
+            "glance_user": session.query(func.count(UserModel.id)).scalar(),
+            "glance_membership": session.query(func.count(MembershipModel.id)).filter(MembershipModel.pending).scalar()
+        }
+
+    redis_cache.set(glance_key, json.dumps(counts), ex=config.admin_glance_ttl)
+
+    return counts
+
+
+Principal = namedtuple("Principal", ["id", "main_character_name", "is_admin", "is_hr", "is_special", "is_internal"])
+
+
+def principal(user_id):
+    """What pages need to know about a user to authorize it, cached until its
+       characters, corporations or memberships change. None for users that
+       don't exist."""
+    cached = redis_cache.get(principal_key.format(user_id))
+
+    if cached:
+        return Principal(*json.loads(cached.decode("utf-8")))
+
+    main = aliased(CharacterModel)
+
+    # Read from the primary, a lagging replica would cache privileges that
+    # were already revoked
+    with primary():
+        row = session.query(
+            UserModel.id, main.character_name, UserModel.is_admin, UserModel.is_hr, UserModel.is_special, UserModel.is_internal
+        ).outerjoin(main, and_(main.user_id==UserModel.id, main.is_main)).filter(UserModel.id==user_id).first()
+
+    if row is None:
+        return None
+
+    current = Principal(row[0], row[1], *(bool(flag) for flag in row[2:]))
+    redis_cache.set(principal_key.format(user_id), json.dumps(current), ex=config.principal_ttl)
+
+    return current
+
+
+def _user_ids(instance):
+    """The users whose principal a change to `instance` affects."""
+    if isinstance(instance, UserModel):
+        return {instance.id}
+
+    state = inspect(instance).attrs
+
+    return {instance.user_id} | set(state.user_id.history.deleted or ()) | {
+        user.id for user in state.user.history.deleted or () if user is not None
+    }
+
+
+@event.listens_for(session.session_factory, "after_flush")
+def flush_cached(current_session, flush_context):
+    changed = current_session.info.setdefault("cached_changed", set())
+
+    for instance in list(current_session.new) + list(current_session.deleted):
+        if type(instance) in cached_columns:
+            changed.update(_user_ids(instance))
+
+    for instance in current_session.dirty:
+        columns = cached_columns.get(type(instance), ())
+
+        if any(inspect(instance).attrs[column].history.has_changes() for column in columns):
+            changed.update(_user_ids(instance))
+
+
+@event.listens_for(session.session_factory, "after_commit")
+def commit_cached(current_session):
+    if current_session.in_nested_transaction():
+        return
+
+    # Bulk writes skip the flush events, those show up once the cache expires
+    changed = current_session.info.pop("cached_changed", None)
+
+    if changed:
+        redis_cache.delete(glance_key, *(principal_key.format(user_id) for user_id in changed if user_id is not None))
+
+
+@event.listens_for(session.session_factory, "after_rollback")
+def rollback_cached(current_session):
+    if current_session.in_nested_transaction():
+        return
+
+    current_session.info.pop("cached_changed", None)
+
+
 if __name__ == '__main__':
     Base.metadata.create_all(engine)
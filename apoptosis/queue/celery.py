@@ -1,12 +1,129 @@
+from collections import namedtuple, OrderedDict
+
 from celery import Celery
+from celery.schedules import crontab
+from celery.signals import task_prerun, task_postrun, worker_process_init
+from kombu import Queue
+
+from apoptosis.models import begin_scope, end_scope, preload_static_indexes
+from apoptosis import config
+
+
+QueueSettings = namedtuple("QueueSettings", ["prefetch", "concurrency"])
+
+# Work is split over queues so latency sensitive polls never wait behind bulk
+# work, most urgent first. There are no message priorities, a worker
+# listening on several queues empties them in this order. Workers run per
+# queue with `apoptosis --worker` so each gets its own prefetch and
+# concurrency.
+queues = OrderedDict([
+    ("location", QueueSettings(config.queue_location_prefetch, config.queue_location_concurrency)),
+    ("tokens", QueueSettings(config.queue_tokens_prefetch, config.queue_tokens_concurrency)),
+    ("corporation", QueueSettings(config.queue_corporation_prefetch, config.queue_corporation_concurrency)),
+    ("skills", QueueSettings(config.queue_skills_prefetch, config.queue_skills_concurrency)),
+    ("maintenance", QueueSettings(config.queue_maintenance_prefetch, config.queue_maintenance_concurrency))
+])
+
+# The queue every poll kind goes to
+poll_queues = {
+    "online": "location",
+    "location": "location",
+    "ship": "location",
+    "corporation": "corporation",
+    "skills": "skills"
+}
+
+# The queue of every task that is not a poll batch
+task_queues = {
+    "apoptosis.queue.user.refresh_character_online": "location",
+    "apoptosis.queue.user.refresh_character_location": "location",
+    "apoptosis.queue.user.refresh_character_ship": "location",
+    "apoptosis.queue.user.refresh_character_corporation": "corporation",
+    "apoptosis.queue.user.refresh_character_skills": "skills",
+    "apoptosis.queue.user.refresh_access_token": "tokens",
+    "apoptosis.queue.retention.compact_history": "maintenance",
+    "apoptosis.queue.skills.sync_skill_groups": "maintenance"
+}
+
+
+def route(name, args, kwargs, options, task=None, **kw):
+    """Send poll batches to the queue of the kind they poll and every other
+       task to its queue in `task_queues`."""
+    if name == "apoptosis.queue.scheduler.poll_batch":
+        return {"queue": poll_queues[args[0]]}
+
+    if name in task_queues:
+        return {"queue": task_queues[name]}
 
-import apoptosis.queue.user
 
 celery_queue = Celery(
     "apoptosis",
-    broker="redis://localhost",
-    backend="redis://localhost"
+    broker=config.celery_broker,
+    backend=config.celery_backend,
+    include=[
+        "apoptosis.queue.scheduler",
+        "apoptosis.queue.user",
+        "apoptosis.queue.retention",
+        "apoptosis.queue.skills"
+    ]
+)
+
+celery_queue.conf.update(
+    task_queues=[Queue(name) for name in queues],
+    task_default_queue="location",
+    task_routes=(route,),
+    # A worker listening on several queues empties them in the order of `queues`
+    broker_transport_options={"queue_order_strategy": "priority"},
+    worker_prefetch_multiplier=1,
+    # Run with `celery -A apoptosis.queue.celery beat`
+    beat_schedule={
+        "compact-history": {
+            "task": "apoptosis.queue.retention.compact_history",
+            "schedule": crontab(hour=config.history_retention_hour, minute=0)
+        },
+        "sync-skill-groups": {
+            "task": "apoptosis.queue.skills.sync_skill_groups",
+            "schedule": crontab(hour=config.history_retention_hour, minute=30, day_of_week=1)
+        }
+    }
 )
 
+
+# The session scope of every running task by its id
+task_scopes = {}
+
+
+@task_prerun.connect
+def begin_task_scope(task_id=None, **kwargs):
+    """Every task starts out with a fresh session."""
+    task_scopes[task_id] = begin_scope()
+
+
+@task_postrun.connect
+def end_task_scope(task_id=None, **kwargs):
+    """Whatever a task left uncommitted is rolled back, failed or not."""
+    end_scope(task_scopes.pop(task_id, None))
+
+
+@worker_process_init.connect
+def preload_worker(**kwargs):
+    """Polls look up static rows by eve id all the time, start out knowing
+       all of them."""
+    preload_static_indexes()
+
+
+def worker(name):
+    """Run a worker for a single queue with the settings of that queue."""
+    settings = queues[name]
+
+    celery_queue.worker_main([
+        "worker",
+        "--queues", name,
+        "--hostname", "{}@%h".format(name),
+        "--concurrency", str(settings.concurrency),
+        "--prefetch-multiplier", str(settings.prefetch)
+    ])
+
+
 if __name__ == "__main__":
     celery_queue.start()
@@ -0,0 +1,276 @@
+from collections import defaultdict
+from datetime import datetime
+
+from apoptosis.models import session
+from apoptosis.models import CharacterSessionHistory, CharacterLocationHistory, EVESolarSystemModel
+from apoptosis.models import CharacterCorporationHistory, EVECorporationModel, EVETypeModel, CharacterShipHistory
+from apoptosis.models import CharacterSkillModel, EVESkillModel, EVEAllianceModel, CharacterSkillGroupModel
+
+from apoptosis.queue.history import history_buffer
+from apoptosis.queue import state
+from apoptosis.queue.skills import skill_groups
+
+from apoptosis.log import eve_log
+
+
+# These write the result of an ESI poll back to a character. They are shared
+# by the celery tasks and the asynchronous poller, committing is left to the
+# caller so results can be written in bulk. Location and ship history goes
+# through the history buffer, changes are detected against the last known
+# state in redis. They return whether anything changed or None when there was
+# no result.
+
+# The state the pollers keep on the character row as well
+state_columns = ("system_id", "eve_type_id", "eve_item_id", "corporation_id", "skillpoints")
+
+
+def known_state(character):
+    """The last known state of a character. Columns of the character that are
+       still empty are filled in from it, characters polled before these
+       columns existed only had their state in their history."""
+    current = state.get(character)
+
+    for column in state_columns:
+        if getattr(character, column) is None and current[column] is not None:
+            setattr(character, column, current[column])
+
+    return current
+
+def update_online(character, online):
+    """Record whether a character is online by opening or closing its session
+       history. Returns the online status."""
+    if online is None:
+        return None
+
+    online = bool(online["online"])
+    current = character.last_session
+
+    if online and (current is None or current.sign_out is not None):
+        session_entry = CharacterSessionHistory(character)
+        session_entry.sign_in = datetime.now()
+        session.add(session_entry)
+
+        eve_log.info("{} signed in".format(character.character_name))
+    elif not online and current is not None and current.sign_out is None:
+        current.sign_out = datetime.now()
+        session.add(current)
+
+        eve_log.info("{} signed out".format(character.character_name))
+
+    return online
+
+
+def update_location(character, location):
+    """Record a characters location, a history entry is only added when the
+       character moved to another system."""
+    if location is None:
+        return None
+
+    system_id = EVESolarSystemModel.index.id(location["solar_system_id"])
+
+    if system_id == known_state(character)["system_id"]:
+        # don't update location history if the user is still in the same system
+        return False
+
+    history_buffer.add(CharacterLocationHistory, {
+        "character_id": character.id,
+        "system_id": system_id,
+        "when": datetime.now()
+    })
+    state.update(character, system_id=system_id)
+
+    character.system_id = system_id
+
+    eve_log.info("{} moved to {}".format(character.character_name, EVESolarSystemModel.index.name(system_id)))
+
+    return True
+
+
+def update_ship(character, ship):
+    """Record a characters ship, a history entry is only added when the
+       character boarded another type of ship."""
+    if ship is None:
+        return None
+
+    eve_type_id = EVETypeModel.index.id(ship["ship_type_id"])
+
+    if eve_type_id == known_state(character)["eve_type_id"]:
+        return False
+
+    history_buffer.add(CharacterShipHistory, {
+        "character_id": character.id,
+        "eve_type_id": eve_type_id,
+        "eve_item_id": ship["ship_item_id"],
+        "when": datetime.now()
+    })
+    state.update(character, eve_type_id=eve_type_id, eve_item_id=ship["ship_item_id"])
+
+    character.eve_type_id = eve_type_id
+    character.eve_item_id = ship["ship_item_id"]
+
+    eve_log.info("{} boarded {}".format(character.character_name, EVETypeModel.index.name(eve_type_id)))
+
+    return True
+
+
+def update_alliance(character, detail):
+    """Keep a characters alliance up to date from its public details."""
+    alliance_id = detail.get("alliance_id")
+
+    if alliance_id == known_state(character)["alliance_id"]:
+        return False
+
+    character.alliance_id = alliance_id
+    character.alliance_name = EVEAllianceModel.index.eve_name(alliance_id) if alliance_id else None
+    session.add(character)
+
+    state.update(character, alliance_id=alliance_id)
+
+    eve_log.info("{} is now in alliance {}".format(character.character_name, character.alliance_name))
+
+    return True
+
+
+def update_corporation(character, detail):
+    """Record a characters corporation and alliance from its public details,
+       closing the previous corporation history entry when it changed."""
+    if detail is None:
+        return None
+
+    alliance_changed = update_alliance(character, detail)
+
+    corporation_id = EVECorporationModel.index.id(detail["corporation_id"])
+
+    # None when this character has no corp history at all
+    current_id = known_state(character)["corporation_id"]
+
+    if corporation_id == current_id:
+        # Character is still in the same corporation as the last time we checked, we need to do nothing
+        return alliance_changed
+
+    now = datetime.now()  # XXX fetch this from the actual join date?
+
+    # Character changed corporation, close the last one and open a new one.
+    # These are rare and written right away, any process may have written the
+    # open entry so it is closed by query rather than through the buffer.
+    if current_id is not None:
+        session.query(CharacterCorporationHistory).filter(
+            CharacterCorporationHistory.character_id==character.id,
+            CharacterCorporationHistory.exit_date.is_(None)
+        ).update({"exit_date": now}, synchronize_session=False)
+
+    session.bulk_insert_mappings(CharacterCorporationHistory, [{
+        "character_id": character.id,
+        "corporation_id": corporation_id,
+        "join_date": now
+    }])
+    state.update(character, corporation_id=corporation_id)
+
+    character.corporation_id = corporation_id
+
+    if current_id is not None:
+        eve_log.info("{} changed corporations {} -> {}".format(
+            character.character_name,
+            EVECorporationModel.index.name(current_id),
+            EVECorporationModel.index.name(corporation_id))
+        )
+
+    return True
+
+
+def update_skill_groups(character, points):
+    """Recount a characters skillpoints per skill group from its skillpoints
+       per EVESkillModel id."""
+    groups = skill_groups(list(points))
+    totals = defaultdict(int)
+
+    for eve_skill_id, skill_points in points.items():
+        if eve_skill_id in groups:
+            totals[groups[eve_skill_id]] += skill_points
+
+    current = {
+        group_id: (characterskillgroup_id, group_points)
+        for characterskillgroup_id, group_id, group_points in session.query(
+            CharacterSkillGroupModel.id,
+            CharacterSkillGroupModel.group_id,
+            CharacterSkillGroupModel.points
+        ).filter(CharacterSkillGroupModel.character_id==character.id)
+    }
+
+    inserts = []
+    updates = []
+
+    for group_id, group_points in totals.items():
+        if group_id not in current:
+            inserts.append({"character_id": character.id, "group_id": group_id, "points": group_points})
+        elif current[group_id][1] != group_points:
+            updates.append({"id": current[group_id][0], "points": group_points})
+
+    if inserts:
+        session.bulk_insert_mappings(CharacterSkillGroupModel, inserts)
+
+    if updates:
+        session.bulk_update_mappings(CharacterSkillGroupModel, updates)
+
+
+def update_skills(character, skills):
+    """Record a characters trained skills and its skillpoints in total and per
+       skill group. Nothing is loaded while its total skillpoints stay the
+       same. Otherwise its current skills are loaded in one query and skill
+       ids come from the static index, only skills that changed are written
+       back in one bulk insert and one bulk update."""
+    if skills is None or "skills" not in skills:
+        return None
+
+    skills = {skill["skill_id"]: skill for skill in skills["skills"]}
+    skillpoints = sum(skill["skillpoints_in_skill"] for skill in skills.values())
+
+    if skillpoints == known_state(character)["skillpoints"]:
+        return False
+
+    eve_skill_ids = EVESkillModel.index.lookup(list(skills))
+
+    current = {
+        eve_skill_id: (characterskill_id, level, points)
+        for characterskill_id, eve_skill_id, level, points in session.query(
+            CharacterSkillModel.id,
+            CharacterSkillModel.eve_skill_id,
+            CharacterSkillModel.level,
+            CharacterSkillModel.points
+        ).filter(CharacterSkillModel.character_id==character.id)
+    }
+
+    inserts = []
+    updates = []
+
+    for skill_id, skill in skills.items():
+        eve_skill_id = eve_skill_ids[skill_id]
+
+        level = skill["current_skill_level"]
+        points = skill["skillpoints_in_skill"]
+
+        if eve_skill_id not in current:
+            inserts.append({"character_id": character.id, "eve_skill_id": eve_skill_id, "level": level, "points": points})
+            continue
+
+        characterskill_id, current_level, current_points = current[eve_skill_id]
+
+        # XXX notify change?
+        if (current_level, current_points) != (level, points):
+            updates.append({"id": characterskill_id, "level": level, "points": points})
+
+    if inserts:
+        session.bulk_insert_mappings(CharacterSkillModel, inserts)
+
+    if updates:
+        session.bulk_update_mappings(CharacterSkillModel, updates)
+
+    update_skill_groups(character, {
+        eve_skill_ids[skill_id]: skill["skillpoints_in_skill"] for skill_id, skill in skills.items()
+    })
+
+    state.update(character, skillpoints=skillpoints)
+
+    character.skillpoints = skillpoints
+
+    return bool(inserts or updates)
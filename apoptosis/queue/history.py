@@ -0,0 +1,168 @@
+import time
+import atexit
+import threading
+
+from collections import defaultdict
+
+from celery.signals import worker_process_shutdown
+
+from apoptosis.models import session, begin_scope, end_scope
+from apoptosis.cache import redis_cache
+from apoptosis.queue import state
+from apoptosis.log import job_log
+
+from apoptosis import config
+
+
+stats_key = "apoptosis:history:stats"
+commits_key = "apoptosis:history:commits:{}"
+
+
+class HistoryBuffer(object):
+    """Collects history rows written by the pollers and writes them behind in
+       bulk, one insert per history table and a single commit, once the buffer
+       holds `size` rows or its oldest row waited `interval` seconds. A timer
+       writes rows that wait that long even when no poll comes along to check.
+
+       A write that fails is tried again with the next one, rows that failed
+       `retries` times are dropped."""
+
+    def __init__(self, size=None, interval=None, retries=None):
+        self.size = size or config.history_buffer_size
+        self.interval = interval or config.history_buffer_interval
+        self.retries = retries or config.history_buffer_retries
+
+        # The timer flushes from its own thread
+        self.lock = threading.Lock()
+        self.timer = None
+
+        self.reset()
+
+    def reset(self):
+        self.inserts = defaultdict(list)
+        self.oldest = None
+        self.attempts = 0
+
+    def __len__(self):
+        return sum(len(rows) for rows in self.inserts.values())
+
+    def _wait(self):
+        if self.oldest is None:
+            self.oldest = time.time()
+
+        if self.timer is None:
+            self.timer = threading.Timer(self.interval, self._flush_timed)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _flush_timed(self):
+        scope = begin_scope()
+
+        try:
+            self.flush()
+        finally:
+            end_scope(scope)
+
+    def add(self, model, row):
+        """Buffer a new history row, `row` maps column names to values."""
+        with self.lock:
+            self.inserts[model].append(row)
+            self._wait()
+
+    def check(self):
+        """Flush when the buffer is full or its oldest row waited long enough.
+           Called after the pollers commit their own work."""
+        if len(self) >= self.size or (self.oldest is not None and time.time() - self.oldest >= self.interval):
+            self.flush()
+
+    def _retry(self, inserts, attempts):
+        with self.lock:
+            for model, mappings in inserts.items():
+                self.inserts[model][:0] = mappings
+
+            self.attempts = max(self.attempts, attempts)
+            self._wait()
+
+    def flush(self):
+        """Write every buffered row and commit."""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            inserts, oldest, attempts = self.inserts, self.oldest, self.attempts
+            self.reset()
+
+        rows = sum(len(mappings) for mappings in inserts.values())
+
+        if not rows:
+            return
+
+        started = time.time()
+
+        try:
+            for model, mappings in inserts.items():
+                session.bulk_insert_mappings(model, mappings)
+
+            session.commit()
+        except Exception:
+            session.rollback()
+
+            if attempts + 1 < self.retries:
+                job_log.exception("failed to write {} history rows, trying again".format(rows))
+                redis_cache.hincrby(stats_key, "retried", rows)
+
+                self._retry(inserts, attempts + 1)
+                return
+
+            job_log.exception("dropped {} history rows".format(rows))
+            redis_cache.hincrby(stats_key, "dropped", rows)
+
+            # The state of these characters no longer matches the database
+            state.forget({row["character_id"] for mappings in inserts.values() for row in mappings})
+            return
+
+        now = time.time()
+
+        pipeline = redis_cache.pipeline()
+        pipeline.hincrby(stats_key, "flushes", 1)
+        pipeline.hincrby(stats_key, "rows", rows)
+        pipeline.hincrbyfloat(stats_key, "flush_seconds", now - started)
+        pipeline.hincrbyfloat(stats_key, "wait_seconds", now - oldest)
+        pipeline.incr(commits_key.format(int(now // 60)))
+        pipeline.expire(commits_key.format(int(now // 60)), 120)
+        pipeline.execute()
+
+        job_log.debug("wrote {} history rows in {:.3f}s".format(rows, now - started))
+
+
+history_buffer = HistoryBuffer()
+
+
+def stats():
+    """Report how often and how fast the buffer gets written."""
+    now = time.time()
+
+    counts = {key.decode("utf-8"): float(value) for key, value in redis_cache.hgetall(stats_key).items()}
+    flushes = counts.get("flushes", 0)
+
+    return {
+        "flushes": int(flushes),
+        "rows": int(counts.get("rows", 0)),
+        "retried": int(counts.get("retried", 0)),
+        "dropped": int(counts.get("dropped", 0)),
+        "rows_per_flush": counts.get("rows", 0) / flushes if flushes else 0,
+        "average_flush_seconds": counts.get("flush_seconds", 0) / flushes if flushes else 0,
+        "average_wait_seconds": counts.get("wait_seconds", 0) / flushes if flushes else 0,
+        "commits_this_minute": int(redis_cache.get(commits_key.format(int(now // 60))) or 0),
+        "commits_last_minute": int(redis_cache.get(commits_key.format(int(now // 60) - 1)) or 0)
+    }
+
+
+# Whatever is still buffered gets written when a worker process goes away
+@worker_process_shutdown.connect
+def flush_on_shutdown(**kwargs):
+    history_buffer.flush()
+
+
+atexit.register(history_buffer.flush)
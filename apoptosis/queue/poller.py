@@ -0,0 +1,159 @@
+from collections import defaultdict
+
+import tornado.gen
+import tornado.locks
+import tornado.ioloop
+import tornado.httpclient
+
+from anoikis.api.exceptions import InvalidToken
+
+from apoptosis.models import session
+from apoptosis.models import EVESolarSystemModel, EVETypeModel, EVECorporationModel, EVEAllianceModel
+from apoptosis.queue.history import history_buffer
+from apoptosis.queue.character import update_online, update_location, update_ship, update_corporation, update_skills
+from apoptosis.queue.character import known_state, state_columns
+
+from apoptosis.eve import esi
+from apoptosis.eve.sso import fetch_access_token
+
+from apoptosis.log import job_log
+
+from apoptosis import config
+
+
+updaters = {
+    "online": update_online,
+    "location": update_location,
+    "ship": update_ship,
+    "corporation": update_corporation,
+    "skills": update_skills
+}
+
+
+# Eve ids in poll results that point at static rows, per kind the index and
+# the key holding the id
+static_ids = {
+    "location": [(EVESolarSystemModel.index, "solar_system_id")],
+    "ship": [(EVETypeModel.index, "ship_type_id")],
+    "corporation": [(EVECorporationModel.index, "corporation_id"), (EVEAllianceModel.index, "alliance_id")]
+}
+
+
+async def resolve_static_ids(results):
+    """Look up the eve ids of a whole pass of results with one lookup per
+       index, so ids that are not known yet get named in a single batch rather
+       than one request per id when each result is written."""
+    eve_ids = defaultdict(set)
+
+    for character, kind, data in results:
+        if not isinstance(data, dict):
+            continue
+
+        for index, key in static_ids.get(kind, []):
+            if key in data:
+                eve_ids[index].add(data[key])
+
+    for index, ids in eve_ids.items():
+        await index.lookup_async(list(ids))
+
+
+def write_result(character, kind, data):
+    """Write a poll result back through the same logic the celery tasks use.
+       Results ESI reported as unchanged are not diffed again."""
+    if data is esi.unchanged:
+        if any(getattr(character, column) is None for column in state_columns):
+            known_state(character)
+
+        return False
+
+    return updaters[kind](character, data)
+
+
+class Poller(object):
+    """Poll ESI for many characters at once on the IOLoop, never running more
+       than `concurrency` requests at the same time. Once every request of a
+       pass is in the results go through `prepare` together and are then
+       handed to `on_result` one by one."""
+
+    def __init__(self, concurrency=None, on_result=write_result, prepare=resolve_static_ids):
+        self.concurrency = concurrency or config.poller_concurrency
+        self.on_result = on_result
+        self.prepare = prepare
+
+        self.semaphore = tornado.locks.Semaphore(self.concurrency)
+        self.client = tornado.httpclient.AsyncHTTPClient(
+            force_instance=True,
+            max_clients=self.concurrency
+        )
+
+        self.polled = 0
+        self.failed = 0
+
+    async def _fetch(self, character, kind):
+        path, authenticated = esi.character_endpoints[kind]
+
+        if not authenticated:
+            return await esi.fetch_character(kind, character.character_id, client=self.client, changes_only=True)
+
+        token = await fetch_access_token(character)
+
+        try:
+            return await esi.fetch_character(kind, character.character_id, access_token=token, client=self.client, changes_only=True)
+        except InvalidToken:
+            token = await fetch_access_token(character, invalid=token)
+            return await esi.fetch_character(kind, character.character_id, access_token=token, client=self.client, changes_only=True)
+
+    async def poll_character(self, character, kind):
+        """Poll a single kind for a character, returns the result or None when
+           the request failed."""
+        try:
+            async with self.semaphore:
+                return (character, kind, await self._fetch(character, kind))
+        except Exception:
+            self.failed += 1
+            job_log.exception("poller {} failed for {}".format(kind, character.character_name))
+
+    async def poll(self, characters, kinds):
+        """Poll every kind in `kinds` for all characters."""
+        results = await tornado.gen.multi([
+            self.poll_character(character, kind)
+            for character in characters
+            for kind in kinds
+        ])
+
+        results = [result for result in results if result is not None]
+
+        if self.prepare is not None:
+            await self.prepare(results)
+
+        for character, kind, data in results:
+            try:
+                self.on_result(character, kind, data)
+            except Exception:
+                self.failed += 1
+                job_log.exception("poller {} failed for {}".format(kind, character.character_name))
+
+                # Not caching this response makes the next poll try it again
+                esi.forget_character(character.character_id, [kind])
+            else:
+                self.polled += 1
+
+    def close(self):
+        self.client.close()
+
+
+def poll_characters(characters, kinds, on_result=write_result, prepare=resolve_static_ids):
+    """Poll characters on a fresh IOLoop and commit the results, buffered
+       history is written once the buffer asks for it. This is the entry point
+       for synchronous code such as the celery workers."""
+    poller = Poller(on_result=on_result, prepare=prepare)
+
+    try:
+        tornado.ioloop.IOLoop.current().run_sync(lambda: poller.poll(characters, kinds))
+    finally:
+        poller.close()
+
+    session.commit()
+    history_buffer.check()
+
+    return poller
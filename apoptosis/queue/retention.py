@@ -0,0 +1,167 @@
+import json
+import time
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from apoptosis.models import session
+from apoptosis.models import CharacterLocationHistory, CharacterLocationDay, CharacterShipHistory, CharacterShipDay
+from apoptosis.cache import redis_cache
+from apoptosis.log import job_log
+
+from apoptosis.queue.celery import celery_queue
+
+from apoptosis import config
+
+
+stats_key = "apoptosis:retention:last"
+
+# Raw history that is rolled up per day, with the table it is rolled up into
+# and the column the rollup is grouped by
+rollups = [
+    (CharacterLocationHistory, CharacterLocationDay, "system_id"),
+    (CharacterShipHistory, CharacterShipDay, "eve_type_id")
+]
+
+
+def _spans(start, end):
+    """Split the time between `start` and `end` over the days it covers."""
+    while start < end:
+        midnight = datetime.combine(start.date() + timedelta(days=1), datetime.min.time())
+
+        yield start.date(), (min(end, midnight) - start).total_seconds()
+
+        start = midnight
+
+
+def _merge(summary, column, character_id, totals):
+    """Add visits and seconds to the rollup rows of a character."""
+    days = {day for day, value in totals}
+
+    existing = {
+        (day, value): (summary_id, visits, seconds)
+        for summary_id, day, value, visits, seconds in session.query(
+            summary.id, summary.day, getattr(summary, column), summary.visits, summary.seconds
+        ).filter(summary.character_id==character_id, summary.day.in_(days))
+    }
+
+    inserts = []
+    updates = []
+
+    for (day, value), (visits, seconds) in totals.items():
+        if (day, value) in existing:
+            summary_id, current_visits, current_seconds = existing[day, value]
+            updates.append({"id": summary_id, "visits": current_visits + visits, "seconds": current_seconds + int(seconds)})
+        else:
+            inserts.append({"character_id": character_id, "day": day, column: value, "visits": visits, "seconds": int(seconds)})
+
+    if inserts:
+        session.bulk_insert_mappings(summary, inserts)
+
+    if updates:
+        session.bulk_update_mappings(summary, updates)
+
+
+def _compact_batch(history, summary, column, character_id, cutoff, batch_size):
+    """Roll up and remove the oldest batch of raw history of a character,
+       returns the amount of removed rows."""
+    rows = session.query(history.id, history.when, getattr(history, column)).filter(
+        history.character_id==character_id
+    ).order_by(history.when, history.id).limit(batch_size + 1).all()
+
+    # An entry lasts until the one after it, so the latest entry is always kept
+    done = [(row, following) for row, following in zip(rows, rows[1:]) if row.when < cutoff]
+
+    if not done:
+        return 0
+
+    totals = defaultdict(lambda: [0, 0])
+
+    for (row_id, started, value), (following_id, ended, following_value) in done:
+        for index, (day, seconds) in enumerate(_spans(started, ended)):
+            totals[day, value][0] += 1 if index == 0 else 0
+            totals[day, value][1] += seconds
+
+    try:
+        _merge(summary, column, character_id, totals)
+
+        session.query(history).filter(
+            history.id.in_([row.id for row, following in done])
+        ).delete(synchronize_session=False)
+
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    return len(done)
+
+
+def _row_bytes(history):
+    """Average size of a row in bytes, only known on PostgreSQL."""
+    if session.get_bind().dialect.name != "postgresql":
+        return None
+
+    size, rows = session.execute(text(
+        "SELECT pg_total_relation_size(oid), reltuples FROM pg_class WHERE relname = :table"
+    ), {"table": history.__tablename__}).first()
+
+    return size / rows if rows else None
+
+
+def compact(days=None, batch_size=None):
+    """Roll location and ship history older than `days` up into per day
+       summaries and remove it. Every batch is its own short transaction."""
+    days = days or config.history_retention_days
+    batch_size = batch_size or config.history_retention_batch_size
+
+    cutoff = datetime.now() - timedelta(days=days)
+    results = {}
+
+    for history, summary, column in rollups:
+        started = time.time()
+        row_bytes = _row_bytes(history)
+
+        character_ids = [
+            character_id for character_id, in session.query(history.character_id).filter(
+                history.when < cutoff
+            ).distinct()
+        ]
+
+        removed = 0
+
+        for character_id in character_ids:
+            while True:
+                batch = _compact_batch(history, summary, column, character_id, cutoff, batch_size)
+                removed += batch
+
+                if batch < batch_size:
+                    break
+
+        results[history.__tablename__] = {
+            "characters": len(character_ids),
+            "rows_removed": removed,
+            "bytes_reclaimed": int(removed * row_bytes) if row_bytes else None,
+            "seconds": round(time.time() - started, 3)
+        }
+
+        job_log.info("retention removed {} rows from {} in {:.1f}s".format(
+            removed, history.__tablename__, time.time() - started))
+
+    redis_cache.set(stats_key, json.dumps(dict(results, finished=datetime.now().isoformat())))
+
+    return results
+
+
+def last_run():
+    """The results of the last retention run or None."""
+    results = redis_cache.get(stats_key)
+    return json.loads(results.decode("utf-8")) if results else None
+
+
+@celery_queue.task(ignore_result=True)
+def compact_history():
+    """Scheduled retention run, see `compact`."""
+    compact()
@@ -0,0 +1,354 @@
+import time
+
+from collections import defaultdict, namedtuple
+
+from sqlalchemy import event
+
+from apoptosis.models import session, CharacterModel
+from apoptosis.cache import redis_cache
+from apoptosis.log import job_log
+
+from apoptosis.queue.celery import celery_queue
+from apoptosis.queue.poller import poll_characters, write_result
+from apoptosis.queue import state
+
+from apoptosis.eve import esi
+
+from apoptosis import config
+
+
+schedule_key = "apoptosis:schedule"
+online_key = "apoptosis:schedule:online"
+interval_key = "apoptosis:schedule:interval"
+stats_key = "apoptosis:schedule:stats"
+lease_key = "apoptosis:schedule:lease:{}"
+
+PollKind = namedtuple("PollKind", ["task", "interval", "offline_interval", "backoff"])
+
+# Maps a poll kind ("location", "ship", ...) to its intervals, filled in by the
+# `poll` decorator when the task modules are imported.
+poll_kinds = {}
+
+
+def poll(kind, interval, offline_interval=None, backoff=False):
+    """Register `kind` to be polled every `interval` seconds for every scheduled
+       character. With an `offline_interval` characters that are not online
+       are only polled at that slower rate. With `backoff` the interval grows
+       while results stay the same, see `report`. The decorated task polls a
+       single character on demand."""
+
+    def decorator(task):
+        poll_kinds[kind] = PollKind(task.name, interval, offline_interval, backoff)
+        return task
+
+    return decorator
+
+
+def _member(kind, character_id):
+    return "{}:{}".format(kind, character_id)
+
+
+def _parse(member):
+    kind, character_id = member.decode("utf-8").split(":")
+    return kind, int(character_id)
+
+
+def _floor(poll_kind):
+    """The shortest interval of a poll, for polls with backoff the configured
+       `poll_backoff_floor` if there is one."""
+    if poll_kind.backoff and config.poll_backoff_floor:
+        return config.poll_backoff_floor
+
+    return poll_kind.interval
+
+
+def schedule(character_id, kind, delay=0):
+    """Put a poll for a character in the schedule. If it is already scheduled
+       the existing due time is kept."""
+    redis_cache.zadd(schedule_key, {_member(kind, character_id): time.time() + delay}, nx=True)
+
+
+def unschedule(character_id):
+    """Remove all polls for a character from the schedule."""
+    members = [_member(kind, character_id) for kind in poll_kinds]
+
+    redis_cache.zrem(schedule_key, *members)
+    redis_cache.hdel(interval_key, *members)
+    redis_cache.delete(*(lease_key.format(member) for member in members))
+    redis_cache.srem(online_key, character_id)
+
+
+def set_online(character_id, online):
+    """Track whether a character is online. When a character comes online its
+       presence gated polls are moved forward so they run right away."""
+    if not online:
+        redis_cache.srem(online_key, character_id)
+        return
+
+    if redis_cache.sadd(online_key, character_id):
+        gated = [kind for kind, poll_kind in poll_kinds.items() if poll_kind.offline_interval]
+
+        if gated:
+            redis_cache.zadd(schedule_key, {_member(kind, character_id): time.time() for kind in gated}, xx=True)
+
+
+def tick(now=None):
+    """Send every poll that is due to the workers in batches and move it to its
+       next due time. Returns the amount of polls that were sent."""
+    now = now or time.time()
+
+    due = redis_cache.zrangebyscore(schedule_key, "-inf", now)
+
+    if not due:
+        return 0
+
+    intervals = redis_cache.hmget(interval_key, due)
+    due = [_parse(member) for member in due]
+
+    pipeline = redis_cache.pipeline()
+
+    for kind, character_id in due:
+        pipeline.sismember(online_key, character_id)
+
+        # A poll holds a lease from being sent until a worker finished it, so
+        # workers that fall behind never get the same poll queued twice.
+        pipeline.set(lease_key.format(_member(kind, character_id)), 1, nx=True, ex=config.poll_lease_timeout)
+
+    results = pipeline.execute()
+
+    batches = defaultdict(list)
+    pipeline = redis_cache.pipeline()
+
+    for (kind, character_id), is_online, leased, interval in zip(due, results[::2], results[1::2], intervals):
+        member = _member(kind, character_id)
+
+        if kind not in poll_kinds:
+            job_log.warn("scheduler dropping unknown poll {}".format(member))
+            pipeline.zrem(schedule_key, member)
+            pipeline.delete(lease_key.format(member))
+            continue
+
+        poll_kind = poll_kinds[kind]
+
+        if poll_kind.offline_interval and not is_online:
+            interval = poll_kind.offline_interval
+        elif interval is not None:
+            interval = float(interval)
+        else:
+            interval = _floor(poll_kind)
+
+        pipeline.zadd(schedule_key, {member: now + interval})
+
+        if leased:
+            batches[kind].append(character_id)
+        else:
+            job_log.warn("scheduler skipping {}, previous poll still running".format(member))
+
+    # The next due times are stored before anything is sent so a crash in
+    # between costs at most a single poll instead of duplicating it.
+    pipeline.execute()
+
+    for kind, character_ids in batches.items():
+        for start in range(0, len(character_ids), config.scheduler_batch_size):
+            poll_batch.apply_async(args=(kind, character_ids[start:start + config.scheduler_batch_size]))
+
+    sent = sum(len(character_ids) for character_ids in batches.values())
+
+    job_log.debug("scheduler sent {} polls".format(sent))
+
+    return sent
+
+
+def report(character_id, kind, changed):
+    """Adapt the interval of a poll with backoff to its result. While results
+       stay the same the interval grows by `poll_backoff_step` up to
+       `poll_backoff_ceiling`, on a change it snaps back to its floor which is
+       `poll_backoff_floor` or the polls own interval."""
+    poll_kind = poll_kinds[kind]
+
+    redis_cache.hincrby(stats_key, "{}:{}".format(kind, "changed" if changed else "unchanged"))
+
+    if not poll_kind.backoff:
+        return
+
+    member = _member(kind, character_id)
+    floor = _floor(poll_kind)
+
+    if changed:
+        redis_cache.hdel(interval_key, member)
+        redis_cache.zadd(schedule_key, {member: time.time() + floor}, xx=True, lt=True)
+    else:
+        interval = float(redis_cache.hget(interval_key, member) or floor)
+        interval = min(max(interval * config.poll_backoff_step, floor), max(config.poll_backoff_ceiling, floor))
+
+        redis_cache.hset(interval_key, member, interval)
+
+
+def stats():
+    """Summarize the current intervals and poll results per kind so the backoff
+       policy can be tuned."""
+    counters = {
+        key.decode("utf-8"): int(value)
+        for key, value in redis_cache.hgetall(stats_key).items()
+    }
+
+    intervals = defaultdict(list)
+
+    for member, interval in redis_cache.hscan_iter(interval_key):
+        kind, character_id = _parse(member)
+        intervals[kind].append(float(interval))
+
+    summary = {}
+
+    for kind, poll_kind in sorted(poll_kinds.items()):
+        backed_off = intervals.get(kind, [])
+        floor = _floor(poll_kind)
+
+        summary[kind] = {
+            "floor": floor,
+            "backed_off": len(backed_off),
+            "mean_interval": sum(backed_off) / len(backed_off) if backed_off else floor,
+            "max_interval": max(backed_off) if backed_off else floor,
+            "changed": counters.get("{}:changed".format(kind), 0),
+            "unchanged": counters.get("{}:unchanged".format(kind), 0)
+        }
+
+    return summary
+
+
+def _worker_chains():
+    # Older versions had every poll task reschedule itself with a countdown,
+    # those chains sit on the workers as tasks with an ETA.
+    task_names = {poll_kind.task for poll_kind in poll_kinds.values()}
+    scheduled = celery_queue.control.inspect().scheduled() or {}
+
+    return [
+        task["request"]
+        for tasks in scheduled.values()
+        for task in tasks
+        if task["request"]["name"] in task_names
+    ]
+
+
+def audit():
+    """Find polls that should not exist: scheduled polls for characters or
+       kinds that are gone, leases of polls that are not scheduled and copies of
+       the self rescheduling task chains older versions left on the workers
+       beyond the first for each character and task."""
+    members = [_parse(member) for member in redis_cache.zrange(schedule_key, 0, -1)]
+    character_ids = {character_id for character_id, in session.query(CharacterModel.id)}
+
+    scheduled = {_member(kind, character_id) for kind, character_id in members}
+    leases = {key.decode("utf-8") for key in redis_cache.scan_iter(lease_key.format("*"))}
+
+    chains = _worker_chains()
+    seen = set()
+    duplicates = []
+
+    for chain in chains:
+        key = (chain["name"], str(chain["args"][:1]))
+
+        if key in seen:
+            duplicates.append(chain)
+        else:
+            seen.add(key)
+
+    return {
+        "scheduled": len(scheduled),
+        "leased": len(leases),
+        "orphaned": sorted(
+            _member(kind, character_id)
+            for kind, character_id in members
+            if kind not in poll_kinds or character_id not in character_ids
+        ),
+        "stale_leases": sorted(lease for lease in leases if lease[len(lease_key.format("")):] not in scheduled),
+        "chains": chains,
+        "duplicate_chains": duplicates
+    }
+
+
+def reap(found):
+    """Remove the orphaned polls, stale leases and duplicate chains `audit`
+       found. The first chain of every character and task is left to run out
+       on its own, the tasks no longer reschedule themselves."""
+    if found["orphaned"]:
+        redis_cache.zrem(schedule_key, *found["orphaned"])
+        redis_cache.hdel(interval_key, *found["orphaned"])
+        redis_cache.delete(*(lease_key.format(member) for member in found["orphaned"]))
+
+    if found["stale_leases"]:
+        redis_cache.delete(*found["stale_leases"])
+
+    for chain in found["duplicate_chains"]:
+        celery_queue.control.revoke(chain["id"])
+
+    job_log.info("scheduler reaped {} orphaned polls, {} stale leases and {} duplicate chains".format(
+        len(found["orphaned"]), len(found["stale_leases"]), len(found["duplicate_chains"])))
+
+
+def run():
+    """Run the scheduler loop. All state lives in redis so a restarted scheduler
+       continues where the previous one stopped."""
+    job_log.info("scheduler started for {}".format(", ".join(sorted(poll_kinds))))
+
+    while True:
+        started = time.time()
+
+        tick(started)
+
+        time.sleep(max(0, config.scheduler_interval - (time.time() - started)))
+
+
+def store_result(character, kind, data):
+    """Write the result of a poll. The schedule follows it once the session
+       commits, a poll that is rolled back leaves the schedule as it was."""
+    result = write_result(character, kind, data)
+
+    if result is None:
+        return
+
+    # An unchanged online status leaves nothing to move in the schedule
+    if kind == "online" and data is esi.unchanged:
+        return
+
+    session.info.setdefault("poll_results", []).append((character.id, kind, result))
+
+
+@event.listens_for(session.session_factory, "after_commit")
+def commit_results(current_session):
+    if current_session.in_nested_transaction():
+        return
+
+    for character_id, kind, result in current_session.info.pop("poll_results", ()):
+        if kind == "online":
+            set_online(character_id, result)
+        else:
+            report(character_id, kind, result)
+
+
+@event.listens_for(session.session_factory, "after_rollback")
+def rollback_results(current_session):
+    if current_session.in_nested_transaction():
+        return
+
+    current_session.info.pop("poll_results", None)
+
+
+@celery_queue.task(ignore_result=True)
+def poll_batch(kind, character_ids):
+    """Poll `kind` for a batch of characters concurrently."""
+    characters = session.query(CharacterModel).filter(CharacterModel.id.in_(character_ids)).all()
+
+    job_log.debug("scheduler.poll_batch {} for {} characters".format(kind, len(characters)))
+
+    try:
+        poll_characters(characters, [kind], on_result=store_result)
+    except Exception:
+        session.rollback()
+
+        # Part of this batch may have been written already, what these
+        # characters last saw is loaded from the database again
+        state.forget(character_ids)
+        raise
+    finally:
+        redis_cache.delete(*(lease_key.format(_member(kind, character_id)) for character_id in character_ids))
@@ -0,0 +1,91 @@
+from sqlalchemy import func
+
+from apoptosis.models import session
+from apoptosis.models import EVESkillModel, EVESkillGroupModel, CharacterSkillModel, CharacterSkillGroupModel
+
+from apoptosis.queue.celery import celery_queue
+
+from apoptosis.eve import esi
+
+from apoptosis.log import job_log
+
+
+# The inventory category all skill groups are in
+skill_category = 16
+
+# EVESkillModel id -> EVESkillGroupModel id, skills never change group
+groups = {}
+
+
+def skill_groups(eve_skill_ids):
+    """Map EVESkillModel ids to the id of their group, skills whose group
+       is not synced yet are left out."""
+    missing = [eve_skill_id for eve_skill_id in eve_skill_ids if eve_skill_id not in groups]
+
+    if missing:
+        for eve_skill_id, group_id in session.query(EVESkillModel.id, EVESkillModel.group_id).filter(
+            EVESkillModel.id.in_(missing),
+            EVESkillModel.group_id != None
+        ):
+            groups[eve_skill_id] = group_id
+
+    return {eve_skill_id: groups[eve_skill_id] for eve_skill_id in eve_skill_ids if eve_skill_id in groups}
+
+
+def recount():
+    """Recount the skillpoints per group of every character in one statement."""
+    session.query(CharacterSkillGroupModel).delete(synchronize_session=False)
+
+    totals = session.query(
+        CharacterSkillModel.character_id,
+        EVESkillModel.group_id,
+        func.sum(CharacterSkillModel.points)
+    ).join(EVESkillModel, EVESkillModel.id==CharacterSkillModel.eve_skill_id).filter(
+        EVESkillModel.group_id != None
+    ).group_by(CharacterSkillModel.character_id, EVESkillModel.group_id)
+
+    session.execute(CharacterSkillGroupModel.__table__.insert().from_select(
+        ["character_id", "group_id", "points"], totals.statement
+    ))
+
+
+def sync():
+    """Load the group of every skill from ESI, then recount the skillpoints per
+       group of every character."""
+    category = esi.request("/universe/categories/{}/".format(skill_category))
+
+    eve_groups = {
+        eve_group_id: esi.request("/universe/groups/{}/".format(eve_group_id))
+        for eve_group_id in category["groups"]
+    }
+
+    group_ids = EVESkillGroupModel.index.lookup(
+        list(eve_groups), names={eve_group_id: group["name"] for eve_group_id, group in eve_groups.items()}
+    )
+
+    eve_skill_groups = {
+        eve_skill_id: group_ids[eve_group_id]
+        for eve_group_id, group in eve_groups.items()
+        for eve_skill_id in group["types"]
+    }
+
+    eve_skill_ids = EVESkillModel.index.lookup(list(eve_skill_groups))
+
+    session.bulk_update_mappings(EVESkillModel, [
+        {"id": eve_skill_ids[eve_skill_id], "group_id": group_id}
+        for eve_skill_id, group_id in eve_skill_groups.items()
+    ])
+
+    recount()
+
+    session.commit()
+
+    job_log.info("synced {} skills in {} groups".format(len(eve_skill_groups), len(eve_groups)))
+
+    return len(eve_skill_groups)
+
+
+@celery_queue.task(ignore_result=True)
+def sync_skill_groups():
+    """Scheduled skill group sync, see `sync`."""
+    sync()
@@ -0,0 +1,156 @@
+from sqlalchemy import func, event
+
+from apoptosis.models import session, CharacterModel, CharacterSkillModel
+from apoptosis.models import CharacterLocationHistory, CharacterShipHistory, CharacterCorporationHistory
+from apoptosis.cache import redis_cache
+from apoptosis.log import job_log
+
+from apoptosis.eve import esi
+
+
+# The last known state of every character as the pollers last saw it, so they
+# can tell whether anything changed without loading any history. Everything in
+# here can be rebuilt from the database with `rebuild`. Updates wait on the
+# session until it commits so a rolled back poll is seen again next time.
+state_key = "apoptosis:state:{}"
+
+fields = ("system_id", "eve_type_id", "eve_item_id", "corporation_id", "alliance_id", "skillpoints")
+
+
+def _encode(state):
+    return {field: "" if value is None else value for field, value in state.items()}
+
+
+def _decode(state):
+    return {
+        field.decode("utf-8"): int(value) if value else None
+        for field, value in state.items()
+    }
+
+
+def _latest(model, columns, character_ids):
+    latest = session.query(func.max(model.id)).filter(
+        model.character_id.in_(character_ids)
+    ).group_by(model.character_id)
+
+    return session.query(model.character_id, *columns).filter(model.id.in_(latest))
+
+
+def load(character_ids):
+    """Load the state of characters from the database."""
+    states = {character_id: dict.fromkeys(fields) for character_id in character_ids}
+
+    if not states:
+        return states
+
+    for character_id, alliance_id in session.query(CharacterModel.id, CharacterModel.alliance_id).filter(
+        CharacterModel.id.in_(character_ids)
+    ):
+        states[character_id]["alliance_id"] = alliance_id
+
+    for character_id, system_id in _latest(CharacterLocationHistory, [CharacterLocationHistory.system_id], character_ids):
+        states[character_id]["system_id"] = system_id
+
+    for character_id, eve_type_id, eve_item_id in _latest(
+        CharacterShipHistory, [CharacterShipHistory.eve_type_id, CharacterShipHistory.eve_item_id], character_ids
+    ):
+        states[character_id]["eve_type_id"] = eve_type_id
+        states[character_id]["eve_item_id"] = eve_item_id
+
+    for character_id, corporation_id in _latest(
+        CharacterCorporationHistory, [CharacterCorporationHistory.corporation_id], character_ids
+    ):
+        states[character_id]["corporation_id"] = corporation_id
+
+    for character_id, skillpoints in session.query(
+        CharacterSkillModel.character_id, func.sum(CharacterSkillModel.points)
+    ).filter(CharacterSkillModel.character_id.in_(character_ids)).group_by(CharacterSkillModel.character_id):
+        states[character_id]["skillpoints"] = int(skillpoints)
+
+    return states
+
+
+def get(character):
+    """The last known state of a character, loaded from the database the first
+       time it is asked for."""
+    state = _decode(redis_cache.hgetall(state_key.format(character.id)))
+
+    if len(state) < len(fields):
+        state = load([character.id])[character.id]
+        redis_cache.hset(state_key.format(character.id), mapping=_encode(state))
+
+    # What this session saw but did not commit yet
+    state.update(session.info.get("state", {}).get(character.id, {}))
+
+    return state
+
+
+def update(character, **values):
+    """Remember what the pollers last saw for a character, once the session
+       commits."""
+    session.info.setdefault("state", {}).setdefault(character.id, {}).update(values)
+
+
+@event.listens_for(session.session_factory, "after_commit")
+def commit_state(current_session):
+    if current_session.in_nested_transaction():
+        return
+
+    pending = current_session.info.pop("state", None)
+
+    if pending:
+        pipeline = redis_cache.pipeline()
+
+        for character_id, values in pending.items():
+            pipeline.hset(state_key.format(character_id), mapping=_encode(values))
+
+        pipeline.execute()
+
+    esi.store_pending()
+
+
+@event.listens_for(session.session_factory, "after_rollback")
+def rollback_state(current_session):
+    if current_session.in_nested_transaction():
+        return
+
+    current_session.info.pop("state", None)
+
+    esi.discard_pending()
+
+
+def forget(character_ids):
+    """Drop the state of characters so it is loaded from the database again,
+       and their cached ESI responses so their next poll is diffed in full."""
+    if not character_ids:
+        return
+
+    redis_cache.delete(*(state_key.format(character_id) for character_id in character_ids))
+
+    for eve_character_id, in session.query(CharacterModel.character_id).filter(CharacterModel.id.in_(character_ids)):
+        esi.forget_character(eve_character_id)
+
+
+def rebuild(batch_size=500):
+    """Reload the state of every character from its history, both in redis and
+       in the current state columns of the character."""
+    character_ids = [character_id for character_id, in session.query(CharacterModel.id).order_by(CharacterModel.id)]
+
+    for start in range(0, len(character_ids), batch_size):
+        states = load(character_ids[start:start + batch_size])
+        pipeline = redis_cache.pipeline()
+
+        for character_id, state in states.items():
+            pipeline.delete(state_key.format(character_id))
+            pipeline.hset(state_key.format(character_id), mapping=_encode(state))
+
+        session.bulk_update_mappings(CharacterModel, [
+            dict(state, id=character_id) for character_id, state in states.items()
+        ])
+        session.commit()
+
+        pipeline.execute()
+
+    job_log.info("rebuilt the state of {} characters".format(len(character_ids)))
+
+    return len(character_ids)
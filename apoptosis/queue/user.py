@@ -2,21 +2,19 @@ import random
 
 import celery
 
-from anoikis.api.eve.esi import characters as esi_characters
 from anoikis.api.exceptions import InvalidToken
 
 from apoptosis.models import session 
-from apoptosis.models import UserModel, CharacterModel, CharacterLocationHistory, EVESolarSystemModel
-from apoptosis.models import CharacterCorporationHistory, EVECorporationModel, EVETypeModel, CharacterShipHistory
-from apoptosis.models import CharacterSkillModel, EVESkillModel
+from apoptosis.models import UserModel, CharacterModel
 
 from apoptosis.queue.celery import celery_queue
+from apoptosis.queue import scheduler
+from apoptosis.queue.history import history_buffer
 
-from apoptosis.log import eve_log, job_log
+from apoptosis.log import job_log
 
-from apoptosis.eve.sso import refresh_access_token
-
-from datetime import datetime
+from apoptosis.eve import esi
+from apoptosis.eve.sso import access_token, has_access_token
 
 
 def setup():
@@ -34,166 +32,104 @@ def setup_user(user):
 def setup_character(character):
     job_log.debug("user.setup_character {}".format(character.character_name))
 
-    refresh_character_location.apply_async(args=(character.id,), countdown=random.randint(0, 120))
-    refresh_character_ship.apply_async(args=(character.id,), countdown=random.randint(0, 120))
-    refresh_character_corporation.apply_async(args=(character.id,), countdown=random.randint(0, 120))
-    refresh_character_skills.apply_async(args=(character.id,), countdown=random.randint(0, 120))
+    # Have an access token ready before the first polls come in, tokens that
+    # are still valid are left alone so a restart doesn't refresh them all
+    if not has_access_token(character.character_id):
+        refresh_access_token.delay(character.id)
 
-@celery_queue.task(ignore_result=True)
-def refresh_character_location(character_id, recurring=30):
-    """Refresh a characters current location."""
+    # Spread out the first polls so a fresh schedule doesn't fire everything at once
+    for kind in scheduler.poll_kinds:
+        scheduler.schedule(character.id, kind, delay=random.randint(0, 120))
 
+@celery_queue.task(ignore_result=True)
+def refresh_access_token(character_id):
+    """Make sure a character has a valid access token cached."""
     character = session.query(CharacterModel).filter(CharacterModel.id==character_id).one()
 
-    job_log.debug("user.refresh_character_location {}".format(character.character_name))
+    job_log.debug("user.refresh_access_token {}".format(character.character_name))
+
+    access_token(character)
+
+def _request(character, kind):
+    """Request an authenticated character endpoint, replacing the access token
+       once if ESI rejects it. Returns `esi.unchanged` when nothing changed
+       since the last request."""
+    token = access_token(character)
 
     try:
-        system_id = esi_characters.location(character.character_id, access_token=character.access_token)
+        return esi.request_character(kind, character.character_id, access_token=token, changes_only=True)
     except InvalidToken:
-        refresh_access_token(character)
-        system_id = esi_characters.location(character.character_id, access_token=character.access_token)
+        return esi.request_character(
+            kind, character.character_id,
+            access_token=access_token(character, invalid=token), changes_only=True
+        )
 
-    if system_id is not None:
-        system_id = system_id["solar_system_id"]
-        system = EVESolarSystemModel.from_id(system_id)
+@scheduler.poll("online", interval=60)
+@celery_queue.task(ignore_result=True)
+def refresh_character_online(character_id):
+    """Refresh whether a character is online."""
 
-        if len(character.location_history) and system.id is character.location_history[-1].system_id:
-            # don't update location history if the user is still in the same system
-            pass
-        else:
-            history_entry = CharacterLocationHistory(character, system)
-            eve_log.info("{} moved to {}".format(character.character_name, system.eve_name))
-            session.add(history_entry)
+    character = session.query(CharacterModel).filter(CharacterModel.id==character_id).one()
 
-    session.commit()
+    job_log.debug("user.refresh_character_online {}".format(character.character_name))
 
-    if recurring:
-        refresh_character_location.apply_async(args=(character_id, recurring), countdown=recurring)
+    scheduler.store_result(character, "online", _request(character, "online"))
 
-@celery_queue.task(ignore_result=True)
-def refresh_character_ship(character_id, recurring=60):
-    """Refresh a characters current ship."""
-    character = session.query(CharacterModel).filter(CharacterModel.id==character_id).one()
+    session.commit()
 
-    job_log.debug("user.refresh_character_ship {}".format(character.character_name))
+# Location and ship are only polled at full rate while the character is online,
+# and back off while the character stays put
+@scheduler.poll("location", interval=30, offline_interval=1800, backoff=True)
+@celery_queue.task(ignore_result=True)
+def refresh_character_location(character_id):
+    """Refresh a characters current location."""
 
-    try:
-        type_id = esi_characters.ship(character.character_id, access_token=character.access_token)
-    except InvalidToken:
-        refresh_access_token(character)
-        type_id = esi_characters.ship(character.character_id, access_token=character.access_token)
+    character = session.query(CharacterModel).filter(CharacterModel.id==character_id).one()
 
-    if type_id is not None:
-        item_id = type_id["ship_item_id"]
-        type_id = type_id["ship_type_id"]
+    job_log.debug("user.refresh_character_location {}".format(character.character_name))
 
-        eve_type = EVETypeModel.from_id(type_id)
+    scheduler.store_result(character, "location", _request(character, "location"))
 
-        if len(character.ship_history) and character.ship_history[-1].eve_type == eve_type:
-            pass
-        else:
-            eve_log.info("{} boarded {}".format(character.character_name, eve_type.eve_name))
+    session.commit()
+    history_buffer.check()
 
-            history_entry = CharacterShipHistory(character, eve_type)
-            history_entry.eve_item_id = item_id
+@scheduler.poll("ship", interval=60, offline_interval=1800, backoff=True)
+@celery_queue.task(ignore_result=True)
+def refresh_character_ship(character_id):
+    """Refresh a characters current ship."""
+    character = session.query(CharacterModel).filter(CharacterModel.id==character_id).one()
 
-            session.add(history_entry)
+    job_log.debug("user.refresh_character_ship {}".format(character.character_name))
 
-        session.commit()
+    scheduler.store_result(character, "ship", _request(character, "ship"))
 
-    if recurring:
-        refresh_character_ship.apply_async(args=(character_id, recurring), countdown=recurring)
+    session.commit()
+    history_buffer.check()
 
 
+@scheduler.poll("corporation", interval=3600)
 @celery_queue.task(ignore_result=True)
-def refresh_character_corporation(character_id, recurring=3600):
+def refresh_character_corporation(character_id):
     character = session.query(CharacterModel).filter(CharacterModel.id==character_id).one()
 
     job_log.debug("user.refresh_character_corporation {}".format(character.character_name))
 
-    corporation_id = esi_characters.detail(character.character_id)
-
-    if corporation_id is not None:
-        corporation_id = corporation_id["corporation_id"]
-
-        corporation = EVECorporationModel.from_id(corporation_id)
-
-        if not len(character.corporation_history):
-            # This character has no corp history at all
-            session_entry = CharacterCorporationHistory(character, corporation)
-            session_entry.join_date = datetime.now()  # XXX fetch this from the actual join date?
-            session.add(session_entry)
-            session.commit()
-            return
-        elif len(character.corporation_history) and character.corporation_history[-1].corporation is corporation:
-            # Character is still in the same corporation as the last time we checked, we need to do nothing
-            return
-        elif len(character.corporation_history) and character.corporation_history[-1].corporation is not corporation:
-            # Character changed corporation, close the last one and create a new one
-            previously = character.corporation_history[-1]
-            previously.exit_date = datetime.now()
-
-            currently = CharacterCorporationHistory(character, corporation)
-            currently.join_date = datetime.now()
-            
-            session.add(currently)
-            session.add(previously)
-
-            session.commit()
-
-            eve_log.info("{} changed corporations {} -> {}".format(
-                character.character_name,
-                previously.corporation.name,
-                currently.corporation.name)
-            )
-
-    if recurring:
-        refresh_character_corporation.apply_async(args=(character_id, recurring), countdown=recurring)
+    scheduler.store_result(character, "corporation", esi.request_character("corporation", character.character_id, changes_only=True))
 
+    session.commit()
+    history_buffer.check()
+
+@scheduler.poll("skills", interval=14400)
 @celery_queue.task(ignore_result=True)
-def refresh_character_skills(character_id, recurring=14400):
+def refresh_character_skills(character_id):
     character = session.query(CharacterModel).filter(CharacterModel.id==character_id).one()
 
     job_log.debug("user.refresh_character_skills {}".format(character.character_name))
 
-    try:
-        skills = esi_characters.skills(character.character_id, access_token=character.access_token)
-    except InvalidToken:
-        refresh_access_token(character)
-        skills = esi_characters.skills(character.character_id, access_token=character.access_token)
-
-    if "skills" in skills:
-        skills = skills["skills"]
+    scheduler.store_result(character, "skills", _request(character, "skills"))
 
-        for skill in skills:
-            skill_id = skill["skill_id"]
-
-            eveskill = EVESkillModel.from_id(skill_id)
-
-            session.add(eveskill)
-
-            skill_level = skill["current_skill_level"]
-            skill_points = skill["skillpoints_in_skill"]
-
-            characterskill = session.query(CharacterSkillModel).filter(
-                CharacterSkillModel.character_id==character.id,
-                CharacterSkillModel.eve_skill_id==eveskill.id
-            ).one_or_none()
-
-            if characterskill is None:
-                characterskill = CharacterSkillModel(character)
-                characterskill.eve_skill = eveskill
-
-            # XXX notify change?
-            characterskill.level = skill_level
-            characterskill.points = skill_points
-
-            session.add(characterskill)
-
-        session.commit()
-
-    if recurring:
-        refresh_character_corporation.apply_async(args=(character_id, recurring), countdown=recurring)
+    session.commit()
+    history_buffer.check()
 
 def refresh_character(character_id):
     pass
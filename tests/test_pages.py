@@ -0,0 +1,144 @@
+"""Render every page against a seeded database and hold it to its query
+   ceiling. Needs the Redis of the configuration, the outside services (SSO,
+   ESI, Slack and the task queue) are replaced."""
+import pytest
+
+import tornado.httpclient
+import tornado.ioloop
+
+from apoptosis import config
+from apoptosis.commands.benchmark import benchmark_database, _site, _serve
+from apoptosis.http import pages
+from apoptosis.models import session, CharacterModel
+from apoptosis.services import slack
+
+import apoptosis.queue.user as queue_user
+
+
+# In order, later requests use what earlier ones created. Groups 1 to 5
+# exist but the admin is in none of them, `{character}` is its character.
+requests = [
+    ("GET", "/", None, pages.HomePage),
+    ("GET", "/login", None, pages.LoginPage),
+    ("GET", "/characters", None, pages.CharactersPage),
+    ("POST", "/characters/select_main", "character_id={character}", pages.CharactersSelectMainPage),
+    ("GET", "/characters/select_main/success", None, pages.CharactersSelectMainSuccessPage),
+    ("GET", "/services", None, pages.ServicesPage),
+    ("POST", "/services/add_slack_identity", "slack_id=benchmark@example.com", pages.ServicesAddSlackIdentityPage),
+    ("GET", "/services/add_slack_identity/success?slackidentity_id=1", None, pages.ServicesAddSlackIdentitySuccessPage),
+    ("POST", "/services/send_slack_verification", "slackidentity_id=1", pages.ServicesSendVerificationSlackIdentityPage),
+    ("POST", "/services/verify_slack_verification", "slackidentity_id=1&code=wrong", pages.ServicesVerifyVerificationSlackIdentityPage),
+    ("GET", "/services/verify_slack_verification/success?slackidentity_id=1", None, pages.ServicesVerifySlackIdentitySuccessPage),
+    ("POST", "/services/delete_slack_identity", "slackidentity_id=1", pages.ServicesDeleteSlackIdentityPage),
+    ("GET", "/groups", None, pages.GroupsPage),
+    ("POST", "/groups/join", "group_id=1", pages.GroupsJoinPage),
+    ("GET", "/groups/join/success?membership_id=1", None, pages.GroupsJoinSuccessPage),
+    ("POST", "/groups/leave", "group_id=1", pages.GroupsLeavePage),
+    ("GET", "/groups/leave/success?group_id=1", None, pages.GroupsLeaveSuccessPage),
+    ("GET", "/ping", None, pages.PingPage),
+    ("POST", "/ping/send_all", "message=benchmark", pages.PingSendAllPage),
+    ("GET", "/ping/send_all/success", None, pages.PingSendAllSuccessPage),
+    ("POST", "/ping/send_group", "group_id=1&message=benchmark", pages.PingSendGroupPage),
+    ("GET", "/ping/send_group/success?group_id=1", None, pages.PingSendGroupSuccessPage),
+    ("GET", "/admin", None, pages.AdminPage),
+    ("GET", "/admin/groups", None, pages.AdminGroupsPage),
+    ("POST", "/admin/groups/create", "group_name=Created&group_slug=created&group_description=Created", pages.AdminGroupsCreatePage),
+    ("GET", "/admin/groups/manage?group_id=1", None, pages.AdminGroupsManagePage),
+    ("POST", "/admin/groups/membership/allow", "membership_id=1", pages.AdminMembershipAllowPage),
+    ("POST", "/admin/groups/membership/deny", "membership_id=2", pages.AdminMembershipDenyPage),
+    ("GET", "/admin/users", None, pages.AdminUsersPage),
+    ("GET", "/admin/users/ip_address?address=10.0.0.1", None, pages.AdminUsersIPAddressPage),
+    ("GET", "/admin/users/detail?user_id=2", None, pages.AdminUsersDetailPage),
+    ("GET", "/admin/characters", None, pages.AdminCharactersPage),
+    ("GET", "/admin/characters/detail?character_id=2", None, pages.AdminCharactersDetailPage),
+    ("GET", "/login/success", None, pages.LoginSuccessPage),
+    ("GET", "/login/created", None, pages.LoginCreatedPage),
+    ("POST", "/logout", "", pages.LogoutPage),
+    ("GET", "/logout/success", None, pages.LogoutSuccessPage)
+]
+
+# The SSO callback adds a character when logged in, otherwise it creates a
+# user for a new character or logs in an existing one
+callbacks = [
+    (True, 95000001),
+    (False, 95000002),
+    (False, 95000002)
+]
+
+
+@pytest.fixture
+def site(monkeypatch):
+    config.tornado_secret = "benchmark"
+
+    statements = benchmark_database(threads=True)
+    cookie = _site(10, 100)
+    character = session.query(CharacterModel.id).filter(CharacterModel.character_id == 90000000).scalar()
+    session.remove()
+
+    callback = {}
+
+    async def sso_response(self):
+        return callback["character_id"], ["esi-location.read_location.v1"], "access", "refresh", "hash"
+
+    async def fetch_details(cls, character_id):
+        return {
+            "name": "Callback {}".format(character_id),
+            "corporation_id": 98000001,
+            "alliance_id": 99000001,
+            "names": {98000001: "Callback Corporation", 99000001: "Callback Alliance"}
+        }
+
+    async def slack_call(*args):
+        return True
+
+    monkeypatch.setattr(pages.LoginCallbackPage, "_sso_response", sso_response)
+    monkeypatch.setattr(CharacterModel, "fetch_details", classmethod(fetch_details))
+    monkeypatch.setattr(queue_user, "setup_character", lambda character: None)
+    monkeypatch.setattr(slack, "verify", slack_call)
+    monkeypatch.setattr(slack, "group_ping", slack_call)
+
+    return statements, cookie, character, callback
+
+
+def test_query_ceilings(site):
+    statements, cookie, character, callback = site
+    counts = []
+
+    async def fetch(client, base, method, path, body, cookie):
+        headers = {"Cookie": "user_id={}".format(cookie)} if cookie else {}
+        response = await client.fetch(
+            base + path, method=method, body=body, headers=headers,
+            follow_redirects=False, raise_error=False)
+
+        assert response.code < 400, "{} {} answered {}".format(method, path, response.code)
+
+    async def render():
+        server, base = _serve()
+        client = tornado.httpclient.AsyncHTTPClient()
+
+        for method, path, body, page in requests:
+            # Pages that only read are requested twice, the first request
+            # fills the static indexes and caches
+            for _ in range(2 if method == "GET" else 1):
+                del statements[:]
+                await fetch(client, base, method, path, body and body.format(character=character), cookie)
+
+            counts.append((path, page, len(statements)))
+
+        for logged_in, character_id in callbacks:
+            callback["character_id"] = character_id
+
+            del statements[:]
+            await fetch(client, base, "GET", "/login/eve-sso-callback?code=code&state=state", None,
+                        cookie if logged_in else None)
+
+            counts.append(("/login/eve-sso-callback", pages.LoginCallbackPage, len(statements)))
+
+        server.stop()
+
+    tornado.ioloop.IOLoop.current().run_sync(render)
+
+    for path, page, count in counts:
+        assert page.query_ceiling is not None, "{} has no query ceiling".format(page.__name__)
+        assert count <= page.query_ceiling, "{} ran {} statements, its ceiling is {}".format(
+            path, count, page.query_ceiling)